@@ -0,0 +1,120 @@
+"""Bloom filter over tokenized programs, used to skip duplicates at
+sampling time (dedupe.py still removes duplicates exactly afterwards).
+
+The bit array is a memory-mapped file, so all generate.py processes on a
+node that open the same path share one filter through the page cache.
+The path is keyed by the data directory. A filter outlives the runs
+that built it; generate.py --reset_bloom_filter reloads it from the
+snapshot in the data directory (or starts empty), e.g. after clearing
+the data. Only reset while no other process uses the filter: processes
+that already have it open keep writing to the discarded file.
+Bits are set without locking, so concurrent writers can occasionally lose
+an insert. This only lets a duplicate through to dedupe, it never causes
+a new program to be skipped (beyond the usual false positive rate).
+"""
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+
+from rasp_gen.dataset.config import DatasetConfig
+from rasp_gen.dataset.logger_config import setup_logger
+
+
+logger = setup_logger(__name__)
+SHM_DIR = Path("/dev/shm")
+
+
+class BloomFilter:
+    def __init__(
+        self,
+        path: Path | str,
+        n_bits: int,
+        n_hashes: int = 7,
+        snapshot: Path | str = None,
+    ):
+        """Open the filter at path, creating it (from snapshot, if
+        given and it exists) if it doesn't exist yet."""
+        self.path = Path(path)
+        self.n_bits = int(n_bits)
+        self.n_hashes = n_hashes
+        n_bytes = (self.n_bits + 7) // 8
+        if not self.path.exists():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+            if snapshot is not None and Path(snapshot).exists():
+                logger.info(f"Loading bloom filter snapshot {snapshot}.")
+                shutil.copyfile(snapshot, tmp)
+            else:
+                np.memmap(tmp, dtype=np.uint8, mode="w+", shape=(n_bytes,)
+                          ).flush()
+            os.replace(tmp, self.path)  # atomic, in case of concurrent init
+        self.bits = np.memmap(self.path, dtype=np.uint8, mode="r+")
+        if len(self.bits) != n_bytes:
+            raise ValueError(f"Bloom filter at {self.path} has "
+                             f"{8 * len(self.bits)} bits, expected {n_bits}.")
+
+    @classmethod
+    def from_config(cls, config: DatasetConfig, reset: bool = False):
+        """Return the filter shared by generate.py processes writing to
+        config.paths.data_dir, or None if config.bloom_filter_bits is not
+        set. If reset, the shared filter is first discarded, so that it
+        is reloaded from config.paths.bloom_filter (or starts empty if
+        there is no snapshot). Don't reset a filter that other processes
+        are using."""
+        if config.bloom_filter_bits is None:
+            return None
+        data_dir = str(config.paths.data_dir.resolve())
+        key = hashlib.blake2b(data_dir.encode(), digest_size=8).hexdigest()
+        shm = SHM_DIR if SHM_DIR.is_dir() else config.paths.data_dir / ".cache"
+        path = shm / f"rasp_gen_bloom_{key}.bin"
+        if reset:
+            path.unlink(missing_ok=True)
+        return cls(
+            path=path,
+            n_bits=config.bloom_filter_bits,
+            snapshot=config.paths.bloom_filter,
+        )
+
+    def _indices(self, tokens: list[int]) -> np.ndarray:
+        """Double hashing: h1 + i * h2 for i < n_hashes."""
+        data = np.asarray(tokens, dtype=np.int32).tobytes()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return np.array([(h1 + i * h2) % self.n_bits
+                         for i in range(self.n_hashes)])
+
+    def __contains__(self, tokens: list[int]) -> bool:
+        idx = self._indices(tokens)
+        return bool(np.all(self.bits[idx // 8] & (1 << (idx % 8))))
+
+    def add(self, tokens: list[int]) -> bool:
+        """Add tokens to the filter. Returns True if they were
+        (probably) already in it."""
+        idx = self._indices(tokens)
+        masks = (1 << (idx % 8)).astype(np.uint8)
+        present = bool(np.all(self.bits[idx // 8] & masks))
+        if not present:
+            np.bitwise_or.at(self.bits, idx // 8, masks)
+        return present
+
+    def snapshot(self, path: Path | str):
+        """Save a copy of the filter to path."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.bits.flush()
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        shutil.copyfile(self.path, tmp)
+        os.replace(tmp, path)
+        logger.info(f"Saved bloom filter snapshot to {path}.")
+
+
+def optimal_size(capacity: int, false_positive_rate: float = 0.01
+                 ) -> tuple[int, int]:
+    """Return (n_bits, n_hashes) for a filter holding capacity items."""
+    n_bits = -capacity * np.log(false_positive_rate) / np.log(2)**2
+    n_hashes = max(1, round(n_bits / capacity * np.log(2)))
+    return int(np.ceil(n_bits)), n_hashes
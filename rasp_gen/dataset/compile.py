@@ -17,6 +17,7 @@ from tracr.compiler.craft_model_to_transformer import NoTokensError
 from rasp_gen.tokenize import tokenizer
 from rasp_gen.tokenize import vocab
 from rasp_gen.dataset import data_utils
+from rasp_gen.dataset import estimate
 from rasp_gen.dataset.config import DatasetConfig, load_config
 from rasp_gen.dataset.logger_config import setup_logger
 from rasp_gen.compress.utils import AssembledModelInfo
@@ -63,6 +64,9 @@ def compile_batch(data: list[dict], config: DatasetConfig):
 
 def unsafe_compile_datapoint(x: dict, config: DatasetConfig):
     prog = tokenizer.detokenize(x['tokens'])
+    reason = estimate.too_large(prog, config)
+    if reason is not None:  # fail before compiling
+        raise data_utils.DataError(f"Estimated {reason}.")
     model = compile_(prog)
     flat, idx = data_utils.flatten_params(model.params, config)
     info = AssembledModelInfo(model=model)
@@ -86,8 +90,8 @@ def compile_datapoint(x: dict, config: DatasetConfig):
 def compile_(program: rasp.SOp):
     return compile_rasp_to_model(
         program,
-        vocab=set(range(5)),
-        max_seq_len=5,
+        vocab=set(estimate.COMPILER_VOCAB),
+        max_seq_len=estimate.COMPILER_MAX_SEQ_LEN,
     )
 
 
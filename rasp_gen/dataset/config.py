@@ -22,6 +22,8 @@ class DatasetPaths:
         self.data_dir = Path(data_dir)
         self.programs_cache  = data_dir / ".cache/programs"
         self.compiled_cache  = data_dir / ".cache/compiled"
+        self.telemetry       = data_dir / ".cache/telemetry"
+        self.bloom_filter    = data_dir / ".cache/bloom_filter.bin"
         self.programs        = data_dir / "programs.h5"  # for deduped programs
         self.dataset         = data_dir / "dataset.h5"
 
@@ -37,6 +39,14 @@ class DatasetConfig:
     compress: str = None  # "svd" or "autoencoder"
     n_augs: int = None  # number of augmentations
     source_data_dir: Path = None
+    bloom_filter_bits: int = None  # skip duplicates while sampling
+    adaptive_op_weights: bool = False  # see sample/op_weights.py
+    goal_directed_sampling: bool = False  # see sample.Sampler
+    use_macros: bool = False  # see sample/program_primitives.py
+    harvest_subprograms: bool = False  # see sample.harvest
+    stratum_quota: int = None  # max datapoints per (n_sops, layer bucket)
+    stratum_quotas: dict = None  # per-stratum overrides, see quotas.py
+    layer_bins: tuple = (5, 10, 15, 20, 30)  # upper edges of layer buckets
     name: str = "default"
 
     def __post_init__(self):
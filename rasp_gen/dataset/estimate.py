@@ -0,0 +1,230 @@
+# Estimate the size of the compiled model (and of the tokenized program)
+# from the program DAG and the value sets of its SOps, without running
+# tracr's basis inference, craft graph construction, or compilation.
+# This mirrors the layer allocation in tracr's craft_graph_to_model and
+# the sizes of the MLPs and attention heads built in tracr.craft.chamber.
+
+
+from collections import defaultdict
+from dataclasses import dataclass
+import numpy as np
+from tracr.rasp import rasp
+
+from rasp_gen.sample import rasp_utils
+from rasp_gen.sample.value_sets import COMPILER_VOCAB, COMPILER_MAX_SEQ_LEN
+from rasp_gen.sample.value_sets import infer_value_sets
+from rasp_gen.dataset.config import DatasetConfig
+from rasp_gen.dataset.logger_config import setup_logger
+
+
+logger = setup_logger(__name__)
+
+
+@dataclass
+class SizeEstimate:
+    n_sublayers: int  # nr of attn and mlp layers = nr of EOL tokens
+    n_tokens: int  # length of the tokenized program
+    d_model: int
+    num_heads: int
+    key_size: int
+    mlp_hidden_size: int
+
+    @property
+    def n_layers(self) -> int:
+        return self.n_sublayers // 2
+
+    @property
+    def n_params(self) -> int:
+        """Nr of weights flattened by data_utils.flatten_params. This is a
+        lower bound, since key_size is (W_OV can be wider than W_QK), so
+        too_large never rejects a program that would have fit."""
+        d, heads, k, h = (self.d_model, self.num_heads,
+                          self.key_size, self.mlp_hidden_size)
+        embed = (COMPILER_MAX_SEQ_LEN + 1) * d + (len(COMPILER_VOCAB) + 2) * d
+        attn = 3 * (d * heads * k + heads * k) + heads * k * d + d
+        mlp = d * h + h + h * d + d
+        return embed + self.n_layers * (attn + mlp)
+
+    @property
+    def n_param_arrays(self) -> int:
+        """Nr of arrays (layer sizes) flattened by data_utils.flatten_params."""
+        return 2 + 12 * self.n_layers
+
+
+def _tokens_per_op(sop: rasp.SOp) -> int:
+    """[varname, encoding, classname, *args, EOO]."""
+    if isinstance(sop, rasp.Map):
+        n_args = 2
+    elif isinstance(sop, rasp.LinearSequenceMap):
+        n_args = 4
+    elif isinstance(sop, rasp.SequenceMap):
+        n_args = 3
+    elif isinstance(sop, rasp.Aggregate):
+        n_args = 4
+    elif isinstance(sop, rasp.SelectorWidth):
+        n_args = 3
+    else:
+        raise ValueError(f"Unsupported SOp: {sop}")
+    return 4 + n_args
+
+
+def allocate_layers(sops: list[rasp.SOp]) -> dict[str, int]:
+    """Map the label of every (non-input) SOp to its layer, numbered
+    0, 1, 2, ... in the order attn, mlp, attn, ... Same allocation as
+    craft_graph_to_model._allocate_modules_to_layers. SelectorWidth
+    occupies its layer and the following mlp layer."""
+    depth = {}
+    for sop in sops:
+        args = rasp_utils.sop_args(sop)
+        depth[sop.label] = 1 + max((depth[a.label] for a in args), default=-1)
+
+    is_attn = lambda sop: isinstance(sop, rasp.Aggregate)
+    is_mlp = lambda sop: isinstance(sop, (rasp.Map, rasp.SequenceMap))
+    sops_by_depth = defaultdict(list)
+    for sop in sops:
+        if is_attn(sop) or is_mlp(sop) or isinstance(sop, rasp.SelectorWidth):
+            sops_by_depth[depth[sop.label]].append(sop)
+
+    # condense attention-only levels followed by mlp-only levels
+    d, max_depth = min(sops_by_depth), max(sops_by_depth)
+    while d < max_depth:
+        if (all(is_attn(s) for s in sops_by_depth[d]) and
+            all(is_mlp(s) for s in sops_by_depth[d + 1])):
+            for update in range(d + 1, max_depth + 1):
+                sops_by_depth[update - 1].extend(sops_by_depth[update])
+                sops_by_depth[update] = []
+            max_depth -= 1
+        d += 1
+
+    layers = {}
+    for d in sorted(sops_by_depth):
+        for sop in sops_by_depth[d]:
+            layers[sop.label] = 2 * (d - 1) + int(is_mlp(sop))
+    return layers
+
+
+def estimate(program: rasp.SOp) -> SizeEstimate:
+    sops = rasp_utils.topological_order(program)
+    value_sets = infer_value_sets(program)
+    layers = allocate_layers(sops)
+
+    def dims(sop: rasp.SOp) -> int:
+        return len(value_sets[sop.label]) if rasp.is_categorical(sop) else 1
+
+    d_model = len(COMPILER_VOCAB) + 2 + COMPILER_MAX_SEQ_LEN  # bos, pad
+    uses_one = False  # the 'one' direction is only added if some block uses it
+    n_tokens = 2  # BOS, EOS
+    heads = defaultdict(int)
+    hidden = defaultdict(int)
+    key_size = 1
+    for sop in sops:
+        if isinstance(sop, (rasp.TokensType, rasp.IndicesType)):
+            continue
+        n_tokens += _tokens_per_op(sop)
+        d_model += dims(sop)
+        layer = layers[sop.label]
+        if isinstance(sop, (rasp.Aggregate, rasp.SelectorWidth)):
+            # only counts the size of W_QK (W_OV can be larger for
+            # categorical Aggregates), so key_size is a lower bound
+            keys, queries = sop.selector.keys, sop.selector.queries
+            heads[layer] += 1
+            key_size = max(key_size, dims(queries) + 2, dims(keys) + 1)
+            uses_one = True
+        if isinstance(sop, rasp.SelectorWidth):
+            d_model += 1  # attention output
+            hidden[layer + 1] += 2 * (COMPILER_MAX_SEQ_LEN + 1)
+        elif isinstance(sop, rasp.LinearSequenceMap):
+            hidden[layer] += 4
+        elif isinstance(sop, rasp.SequenceMap):
+            fst, snd = sop.fst, sop.snd
+            if fst.label == snd.label:
+                hidden[layer] += dims(sop)
+            else:
+                hidden[layer] += dims(fst) * dims(snd)
+                uses_one = True
+        elif isinstance(sop, rasp.Map):
+            if rasp.is_categorical(sop.inner):
+                hidden[layer] += dims(sop)
+            else:  # discretising MLP
+                n_values = len(value_sets[sop.inner.label])
+                hidden[layer] += 1 + 2 * (n_values - 1)
+                uses_one = True
+
+    max_layer = max(layers.values(), default=0)
+    max_layer = max([max_layer] + [
+        layers[s.label] + 1 for s in sops if isinstance(s, rasp.SelectorWidth)])
+    n_sublayers = max_layer + 1 + (max_layer + 1) % 2
+    return SizeEstimate(
+        n_sublayers=n_sublayers,
+        n_tokens=n_tokens + n_sublayers,
+        d_model=d_model + int(uses_one),
+        num_heads=max(heads.values(), default=1),
+        key_size=key_size,
+        mlp_hidden_size=max(hidden.values(), default=1),
+    )
+
+
+def too_large(program: rasp.SOp, config: DatasetConfig) -> str | None:
+    """Return a reason if the program is predicted to be filtered out
+    by generate.to_filter or by data_utils.flatten_params, else None."""
+    est = estimate(program)
+    if est.n_tokens > config.max_rasp_length:
+        return "too many tokens"
+    elif 1 + est.n_sublayers > config.max_layers:
+        return "too many layers"
+    elif est.n_param_arrays > config.max_layers:
+        return "too many layers"
+    elif est.n_params > config.max_weights_length:
+        return "too many params"
+    return None
+
+
+def count_params(params: dict) -> int:
+    """Nr of weights in compiled params that are kept by flatten_params."""
+    from rasp_gen.dataset.data_utils import layer_names
+    return sum(v.size for k in layer_names() if k in params
+               for v in params[k].values())
+
+
+def calibrate(
+    rng: np.random.Generator,
+    n_programs: int = 100,
+    program_length: int | list[int] = (4, 5, 6, 7, 8),
+) -> dict:
+    """Compile sampled programs and compare the real sizes to the
+    estimates. Returns the fraction of exact estimates per quantity and
+    the min / max ratio of real to estimated nr of params (the min 
+    should be >= 1, since n_params is a lower bound)."""
+    from rasp_gen.dataset import compile
+    from rasp_gen.dataset import generate  # avoid circular import
+    from rasp_gen.tokenize import tokenizer
+    from rasp_gen.tokenize import vocab
+    from rasp_gen.compress.utils import AssembledModelInfo
+
+    exact = defaultdict(list)
+    ratios = []
+    n_failed = 0
+    for _ in range(n_programs):
+        program = generate.sample_rasp(rng, program_length)
+        est = estimate(program)
+        try:
+            tokens = tokenizer.tokenize(program)
+            model = compile.compile_(program)
+        except Exception as e:
+            logger.warning(f"Failed to compile program ({e}).")
+            n_failed += 1
+            continue
+        info = AssembledModelInfo(model=model)
+        n_params = count_params(model.params)
+        exact["n_tokens"].append(est.n_tokens == len(tokens))
+        exact["n_sublayers"].append(est.n_sublayers == tokens.count(vocab.eol_id))
+        exact["n_layers"].append(est.n_layers == info.num_layers)
+        exact["d_model"].append(est.d_model == info.d_model)
+        exact["num_heads"].append(est.num_heads == info.num_heads)
+        ratios.append(n_params / est.n_params)
+    return {
+        "exact": {k: float(np.mean(v)) for k, v in exact.items()},
+        "min_params_ratio": float(np.min(ratios)),
+        "max_params_ratio": float(np.max(ratios)),
+        "n_failed": n_failed,
+    }
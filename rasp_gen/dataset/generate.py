@@ -1,5 +1,9 @@
 import os
 os.environ["JAX_PLATFORMS"] = "cpu"
+from collections import deque
+import copy
+import multiprocessing
+import time
 import numpy as np
 from tqdm import tqdm
 import argparse
@@ -9,11 +13,19 @@ from tracr.compiler.craft_model_to_transformer import NoTokensError
 from tracr.rasp import rasp
 
 from rasp_gen.sample import sample
+from rasp_gen.sample import mutate
+from rasp_gen.sample import enumeration
+from rasp_gen.sample.telemetry import SamplingTelemetry
+from rasp_gen.sample.op_weights import AdaptiveOpWeights
 from rasp_gen.tokenize import tokenizer
 from rasp_gen.dataset.logger_config import setup_logger
 from rasp_gen.dataset.config import DatasetConfig, load_config
 from rasp_gen.dataset.data_utils import save_json
 from rasp_gen.dataset import data_utils
+from rasp_gen.dataset import estimate
+from rasp_gen.dataset.bloom import BloomFilter
+from rasp_gen.dataset.quotas import StratifiedQuotas
+from rasp_gen.dataset.dataloading import load_dataset
 from rasp_gen.dataset import Signals
 from rasp_gen.globals import disable_tqdm
 from rasp_gen.tokenize import vocab
@@ -22,6 +34,8 @@ from rasp_gen.tokenize.str_to_rasp import split_list
 
 logger = setup_logger(__name__)
 VERBOSE = False
+_op_weights: dict[str, AdaptiveOpWeights] = {}  # per config, in this process
+_bloom_filters: dict[str, BloomFilter] = {}  # per data dir, in this process
 
 
 def generate_batches(
@@ -29,16 +43,124 @@ def generate_batches(
     config: DatasetConfig,
     ndata: int = 100,
     disable_tqdm: bool = False,
+    workers: int = 1,
+    snapshot_bloom_filter: bool = False,
+    reset_bloom_filter: bool = False,
 ):
+    """Sample ndata programs in batches and save each batch to
+    config.paths.programs_cache.
+
+    Every batch is sampled with its own generator, spawned from rng
+    (via SeedSequence.spawn). Batches are saved in order by the main 
+    process, so the output only depends on the seed of rng and on ndata,
+    not on the number of workers.
+
+    Sampler telemetry (rejections and timings per op class) is merged 
+    across batches and saved to config.paths.telemetry at the end.
+
+    If config.bloom_filter_bits is set, programs that were already saved
+    by any process writing to the same data dir on this node are skipped
+    (see get_bloom_filter; reset_bloom_filter discards the filter of 
+    earlier runs, so only pass it if no other run is using it). This makes
+    the output depend on the order in which batches finish if workers > 1.
+    The same holds for config.adaptive_op_weights, since the weights are
+    learned across all batches sampled by a process.
+
+    If config sets stratum quotas (see quotas.py), datapoints in strata
+    that are already full are dropped here, and sampling stops early once
+    all strata are full. Each batch steers its program lengths with a 
+    copy of the quotas taken when the batch is started.
+    """
     logger.info("Begin sampling RASP programs.")
     bs = min(ndata, 200)
     nbatches = np.ceil(ndata / bs).astype(int)
-    for i in range(nbatches):
-        if i == nbatches - 1:
-            bs = ndata - i * bs
-        generate_batch(rng, bs, config=config, disable_tqdm=disable_tqdm)
-        if Signals.sigterm:
-            break
+    sizes = (bs if i < nbatches - 1 else ndata - i * bs 
+             for i in range(nbatches))
+    quotas = StratifiedQuotas.from_config(config)
+    bloom_filter = get_bloom_filter(config, reset=reset_bloom_filter)
+    jobs = ((rng.spawn(1)[0], size, config, copy.deepcopy(quotas))
+            for size in sizes)
+    telemetry = SamplingTelemetry()
+
+    def collect(data, filename, batch_telemetry):
+        data = [x for x in data
+                if _accept(x, telemetry, quotas=quotas, bloom_filter=bloom_filter)]
+        _save_batch(data, filename, config)
+        telemetry.merge(batch_telemetry)
+
+    def done():
+        return Signals.sigterm or (quotas is not None and quotas.full)
+
+    if workers <= 1:
+        for job in jobs:
+            collect(*_sample_batch_job(job, disable_tqdm=disable_tqdm))
+            if done():
+                break
+    else:
+        # keep a bounded number of batches in flight, since ndata may be
+        # (practically) unbounded
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            pending = deque()
+            for job in jobs:
+                pending.append(pool.apply_async(_sample_batch_job, (job,)))
+                if len(pending) >= 2 * workers:
+                    collect(*pending.popleft().get())
+                if done():
+                    break
+            while pending and not Signals.n_sigterms >= 2:
+                collect(*pending.popleft().get())
+
+    save_telemetry(telemetry, config)
+    if snapshot_bloom_filter and bloom_filter is not None:
+        bloom_filter.snapshot(config.paths.bloom_filter)
+    return telemetry
+
+
+def save_telemetry(telemetry: SamplingTelemetry, config: DatasetConfig):
+    filename = f"telemetry_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}"
+    savepath = config.paths.telemetry / (filename + ".json")
+    logger.info(f"Saving sampler telemetry to {savepath}")
+    telemetry.dump(savepath)
+
+
+def _accept(
+    datapoint: dict,
+    telemetry: SamplingTelemetry,
+    quotas: StratifiedQuotas = None,
+    bloom_filter: BloomFilter = None,
+) -> bool:
+    """Decide whether to save a datapoint. Duplicates and datapoints in
+    full strata are rejected; accepted ones are counted towards their
+    stratum and only then added to the Bloom filter, so that the filter
+    holds exactly the saved programs."""
+    if bloom_filter is not None and datapoint["tokens"] in bloom_filter:
+        telemetry.record("accept", reason="duplicate")
+        return False
+    if quotas is not None and not quotas.add(datapoint):
+        telemetry.record("accept", reason="quota full")
+        return False
+    if bloom_filter is not None:
+        bloom_filter.add(datapoint["tokens"])
+    telemetry.record("accept")
+    return True
+
+
+def _sample_batch_job(
+    job: tuple[np.random.Generator, int, DatasetConfig, StratifiedQuotas],
+    disable_tqdm: bool = True,
+) -> tuple[list[dict], str, SamplingTelemetry]:
+    """Sample a batch and draw its filename from the batch generator."""
+    rng, batch_size, config, quotas = job
+    telemetry = SamplingTelemetry()
+    data = sample_batch(rng, batch_size, config, disable_tqdm=disable_tqdm,
+                        telemetry=telemetry, quotas=quotas)
+    return data, data_utils.get_filename(rng), telemetry
+
+
+def _save_batch(data: list[dict], filename: str, config: DatasetConfig):
+    if not Signals.n_sigterms >= 2:  # avoid saving after 2nd sigterm
+        save_json(data=data, savedir=config.paths.programs_cache,
+                  filename=filename)
 
 
 def generate_batch(
@@ -46,54 +168,282 @@ def generate_batch(
     batch_size: int,
     config: DatasetConfig, 
     disable_tqdm: bool = False,
+    telemetry: SamplingTelemetry = None,
+) -> list[dict]:
+    telemetry = telemetry if telemetry is not None else SamplingTelemetry()
+    data = sample_batch(rng, batch_size, config, disable_tqdm=disable_tqdm,
+                        telemetry=telemetry)
+    bloom_filter = get_bloom_filter(config)
+    data = [x for x in data
+            if _accept(x, telemetry, bloom_filter=bloom_filter)]
+    _save_batch(data, data_utils.get_filename(rng), config)
+    return data
+
+
+def sample_batch(
+    rng, 
+    batch_size: int,
+    config: DatasetConfig, 
+    disable_tqdm: bool = False,
+    telemetry: SamplingTelemetry = None,
+    quotas: StratifiedQuotas = None,
 ) -> list[dict]:
+    """Sample and tokenize a batch of programs, without saving.
+    If quotas are given, program lengths are drawn with 
+    quotas.sample_length instead of uniformly from config.program_length,
+    and datapoints in strata that are full are skipped (quotas is updated
+    in place).
+    If config.harvest_subprograms, the intermediate SOps of each program
+    whose lengths are in config.program_length and that pass the checks
+    are added as datapoints as well (see sample.harvest), so the batch
+    can hold more than batch_size datapoints."""
+    telemetry = telemetry if telemetry is not None else SamplingTelemetry()
+    bloom_filter = get_bloom_filter(config)
+    op_weights = get_op_weights(config)
     data = []
     for i in tqdm(range(batch_size), disable=disable_tqdm, desc="Sampling"):
-        program = sample_rasp(rng, config.program_length)
-        try:
-            tokens = tokenizer.tokenize(program)
-        except (InvalidValueSetError, NoTokensError) as e:
-            logger.warning(f"Skipping program {i} ({e}).")
-            continue
+        harvested = [] if config.harvest_subprograms else None
+        program_length = (config.program_length if quotas is None
+                          else quotas.sample_length(rng))
+        program = sample_rasp(rng, program_length, telemetry=telemetry,
+                              op_weights=op_weights,
+                              goal_directed=config.goal_directed_sampling,
+                              use_macros=config.use_macros,
+                              harvested=harvested,
+                              harvest_lengths=config.program_length)
+        for program in [program] + (harvested or []):
+            datapoint = to_datapoint(program, i, config, telemetry, bloom_filter)
+            if datapoint is None:
+                continue
+            if quotas is not None and not quotas.add(datapoint):
+                # accepted datapoints are recorded when collected
+                telemetry.record("accept", reason="quota full")
+                continue
+            data.append(datapoint)
+
+    return data
+
+
+def to_datapoint(
+    program: rasp.SOp,
+    i: int,
+    config: DatasetConfig,
+    telemetry: SamplingTelemetry,
+    bloom_filter: BloomFilter = None,
+) -> dict | None:
+    """Tokenize a sampled program (the i-th of its batch). Returns None
+    if the program is filtered out, or if it is already in bloom_filter
+    (programs are only added to the filter once saved, see _accept)."""
+    start = time.time()
+    reason = estimate.too_large(program, config)
+    if reason is not None:  # cheaper than finding out after tokenizing
+        logger.warning(f"Skipping program {i} (estimated {reason}).")
+        telemetry.record("filter", time.time() - start, 
+                         reason=f"estimated {reason}")
+        return None
+
+    try:
+        tokens = tokenizer.tokenize(program)
+    except (InvalidValueSetError, NoTokensError) as e:
+        logger.warning(f"Skipping program {i} ({e}).")
+        telemetry.record("filter", time.time() - start,
+                         reason=type(e).__name__)
+        return None
 
-        if to_filter(tokens, config=config):
-            logger.warning(f"Skipping program {i} (too long).")
+    if to_filter(tokens, config=config):
+        logger.warning(f"Skipping program {i} (too long).")
+        telemetry.record("filter", time.time() - start, reason="too long")
+        return None
+
+    tokens = data_utils.pad_to(
+        np.array(tokens),
+        config.max_rasp_length, 
+        pad_value=vocab.pad_id,
+    ).tolist()
+
+    if bloom_filter is not None and tokens in bloom_filter:
+        logger.debug(f"Skipping program {i} (duplicate).")
+        telemetry.record("filter", time.time() - start, reason="duplicate")
+        return None
+    telemetry.record("filter", time.time() - start)
+
+    return {
+        "n_sops": program.annotations['length'],  # nr of sops
+        "tokens": tokens,
+        "n_layers": tokens.count(vocab.eol_id),
+    }
+
+
+def enumerate_batches(
+    rng: np.random.Generator,
+    config: DatasetConfig,
+    max_length: int,
+    workers: int = 1,
+    reset_bloom_filter: bool = False,
+):
+    """Enumerate all programs of lengths config.program_length up to
+    max_length that pass the checks (see sample/enumeration.py) and save
+    them to config.paths.programs_cache, one batch per worker. Each
+    worker checks an interleaved share of the programs."""
+    logger.info(f"Begin enumerating RASP programs up to length {max_length}.")
+    min_length = min(np.atleast_1d(config.program_length))
+    jobs = [(rng.spawn(1)[0], w, workers, min_length, max_length, config)
+            for w in range(workers)]
+    telemetry = SamplingTelemetry()
+    bloom_filter = get_bloom_filter(config, reset=reset_bloom_filter)
+    if workers <= 1:
+        results = [_enumerate_job(job) for job in jobs]
+    else:
+        with multiprocessing.get_context("spawn").Pool(workers) as pool:
+            results = pool.map(_enumerate_job, jobs)
+    for data, filename, worker_telemetry in results:
+        data = [x for x in data
+                if _accept(x, telemetry, bloom_filter=bloom_filter)]
+        _save_batch(data, filename, config)
+        telemetry.merge(worker_telemetry)
+    save_telemetry(telemetry, config)
+    return telemetry
+
+
+def _enumerate_job(
+    job: tuple[np.random.Generator, int, int, int, int, DatasetConfig],
+) -> tuple[list[dict], str, SamplingTelemetry]:
+    rng, worker, n_workers, min_length, max_length, config = job
+    telemetry = SamplingTelemetry()
+    bloom_filter = get_bloom_filter(config)
+    lengths = np.atleast_1d(config.program_length).tolist()
+    programs = enumeration.enumerate_programs(
+        max_length, min_length=min_length, worker=worker,
+        n_workers=n_workers, telemetry=telemetry)
+    data = []
+    for i, program in enumerate(programs):
+        if program.annotations["length"] not in lengths:
             continue
+        datapoint = to_datapoint(program, i, config, telemetry, bloom_filter)
+        if datapoint is not None:
+            data.append(datapoint)
+    return data, data_utils.get_filename(rng), telemetry
 
-        tokens = data_utils.pad_to(
-            np.array(tokens),
-            config.max_rasp_length, 
-            pad_value=vocab.pad_id,
-        ).tolist()
 
-        data.append({
-            "n_sops": program.annotations['length'],  # nr of sops
-            "tokens": tokens,
-            "n_layers": tokens.count(vocab.eol_id),
-        })
+def mutate_batches(
+    rng: np.random.Generator,
+    config: DatasetConfig,
+    ndata: int = 100,
+    disable_tqdm: bool = False,
+    reset_bloom_filter: bool = False,
+):
+    """Like generate_batches, but instead of sampling programs from
+    scratch, mutate programs from config.paths.programs (see 
+    sample/mutate.py). Mutants whose lengths aren't in 
+    config.program_length are skipped."""
+    logger.info("Begin mutating RASP programs.")
+    corpus = load_dataset(config.paths.programs, group=None, end=None)["tokens"]
+    telemetry = SamplingTelemetry()
+    bloom_filter = get_bloom_filter(config, reset=reset_bloom_filter)
+    bs = min(ndata, 200)
+    for i in range(np.ceil(ndata / bs).astype(int)):
+        batch_rng = rng.spawn(1)[0]
+        data = mutate_batch(batch_rng, min(bs, ndata - i * bs), config, corpus,
+                            disable_tqdm=disable_tqdm, telemetry=telemetry)
+        data = [x for x in data
+                if _accept(x, telemetry, bloom_filter=bloom_filter)]
+        _save_batch(data, data_utils.get_filename(batch_rng), config)
+        if Signals.sigterm:
+            break
+    save_telemetry(telemetry, config)
+    return telemetry
 
-    if not Signals.n_sigterms >= 2:  # avoid saving after 2nd sigterm
-        save_json(rng=rng, data=data, savedir=config.paths.programs_cache)
 
+def mutate_batch(
+    rng: np.random.Generator,
+    batch_size: int,
+    config: DatasetConfig,
+    corpus: np.ndarray,
+    disable_tqdm: bool = False,
+    telemetry: SamplingTelemetry = None,
+) -> list[dict]:
+    """Mutate batch_size random programs from corpus (an array of
+    tokenized programs) and tokenize the mutants that pass the checks."""
+    telemetry = telemetry if telemetry is not None else SamplingTelemetry()
+    bloom_filter = get_bloom_filter(config)
+    lengths = np.atleast_1d(config.program_length).tolist()
+    data = []
+    for i in tqdm(range(batch_size), disable=disable_tqdm, desc="Mutating"):
+        program = tokenizer.detokenize(corpus[rng.choice(len(corpus))].tolist())
+        try:
+            mutant = mutate.mutate(rng, program, telemetry=telemetry)
+        except sample.SamplingError as e:
+            logger.debug(f"Skipping mutant {i} ({e}).")
+            continue
+        if mutant.annotations["length"] not in lengths:
+            telemetry.record("filter", reason="length")
+            continue
+        datapoint = to_datapoint(mutant, i, config, telemetry, bloom_filter)
+        if datapoint is not None:
+            data.append(datapoint)
     return data
 
 
+def get_bloom_filter(
+    config: DatasetConfig,
+    reset: bool = False,
+) -> BloomFilter | None:
+    """Return the Bloom filter for config.paths.data_dir, opened once per
+    process (None if config.bloom_filter_bits isn't set). The filter is
+    shared with all processes on this node that write to the same data
+    dir. If reset, it is first reloaded from its snapshot, which must 
+    only be done while no other process is using it."""
+    key = str(config.paths.data_dir)
+    if reset or key not in _bloom_filters:
+        _bloom_filters[key] = BloomFilter.from_config(config, reset=reset)
+    return _bloom_filters[key]
+
+
+def get_op_weights(config: DatasetConfig) -> AdaptiveOpWeights | None:
+    """Return the adaptive op weights shared by all batches sampled with
+    this config in the current process, or None if they're disabled."""
+    if not config.adaptive_op_weights:
+        return None
+    if config.name not in _op_weights:
+        _op_weights[config.name] = AdaptiveOpWeights()
+    return _op_weights[config.name]
+
+
 def sample_rasp(
     rng: np.random.Generator,
     program_length: int | list[int],
+    telemetry: SamplingTelemetry = None,
+    op_weights: AdaptiveOpWeights = None,
+    goal_directed: bool = False,
+    use_macros: bool = False,
+    harvested: list = None,
+    harvest_lengths: int | list[int] = None,
 ) -> rasp.SOp:
-    """Sample a program while catching and logging errors."""
+    """Sample a program while catching and logging errors.
+    If harvested is given, qualifying intermediate SOps are appended to it
+    (see sample.sample), using harvest_lengths as target lengths (default:
+    all of program_length)."""
     try:
         program_length = int(program_length)
+        lengths = [program_length]
     except TypeError:
-        program_length = rng.choice(list(program_length))
+        lengths = list(program_length)
+        program_length = rng.choice(lengths)
+    if harvest_lengths is None:
+        harvest_lengths = lengths
+    elif isinstance(harvest_lengths, int):
+        harvest_lengths = [harvest_lengths]
 
-    try:
-        program = sample.sample(rng, program_length)
-    except sample.SamplingError as e:
-        logger.warning(f"Received sampling error: {e}.")
-        return sample_rasp(rng, program_length)
-    return program
+    while True:
+        try:
+            return sample.sample(rng, program_length, telemetry=telemetry,
+                                 op_weights=op_weights,
+                                 goal_directed=goal_directed,
+                                 use_macros=use_macros,
+                                 harvested=harvested,
+                                 harvest_lengths=harvest_lengths)
+        except sample.SamplingError as e:
+            logger.warning(f"Received sampling error: {e}.")
 
 
 def to_filter(tokens: list[int], config: DatasetConfig):
@@ -121,6 +471,24 @@ def parse_args():
     parser.add_argument('--disable_tqdm', action='store_true')
     parser.add_argument('--config', type=str, default=None,
                         help="Name of config file.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of sampling processes.")
+    parser.add_argument('--bloom_filter_bits', type=int, default=None,
+                        help="Skip duplicates while sampling with a Bloom "
+                             "filter of this many bits (overrides config).")
+    parser.add_argument('--snapshot_bloom_filter', action='store_true',
+                        help="Save the duplicate filter to disk at the end.")
+    parser.add_argument('--reset_bloom_filter', action='store_true',
+                        help="Reload the duplicate filter from its snapshot "
+                             "at the start. Only use this if no other run "
+                             "writes to the same data dir.")
+    parser.add_argument('--enumerate', type=int, default=None,
+                        metavar="MAX_LENGTH",
+                        help="Enumerate all programs up to MAX_LENGTH instead "
+                             "of sampling.")
+    parser.add_argument('--mutate', action='store_true',
+                        help="Mutate programs from programs.h5 instead of "
+                             "sampling new ones.")
     args = parser.parse_args()
     if disable_tqdm:
         args.disable_tqdm = True
@@ -129,8 +497,23 @@ def parse_args():
 
 if __name__ == "__main__":
     args = parse_args()
-    rng = np.random.default_rng(args.seed)
+    seed_seq = np.random.SeedSequence(args.seed)
+    logger.info(f"Seed entropy: {seed_seq.entropy}")
+    rng = np.random.default_rng(seed_seq)
     config = load_config(args.config)
+    if args.bloom_filter_bits is not None:
+        config = config.replace(bloom_filter_bits=args.bloom_filter_bits)
 
-    generate_batches(rng, config, ndata=args.ndata, 
-                     disable_tqdm=args.disable_tqdm)
\ No newline at end of file
+    if args.enumerate is not None:
+        enumerate_batches(rng, config, max_length=args.enumerate,
+                          workers=args.workers,
+                          reset_bloom_filter=args.reset_bloom_filter)
+    elif args.mutate:
+        mutate_batches(rng, config, ndata=args.ndata,
+                       disable_tqdm=args.disable_tqdm,
+                       reset_bloom_filter=args.reset_bloom_filter)
+    else:
+        generate_batches(rng, config, ndata=args.ndata, 
+                         disable_tqdm=args.disable_tqdm, workers=args.workers,
+                         snapshot_bloom_filter=args.snapshot_bloom_filter,
+                         reset_bloom_filter=args.reset_bloom_filter)
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""Quotas on the nr of datapoints per stratum, where a stratum is a pair
+(n_sops, layer bucket), and n_layers is bucketed by config.layer_bins.
+
+generate.py keeps one StratifiedQuotas in the main process. Datapoints
+are only saved if their stratum is still under quota, and sampling stops
+once all strata are full. Every batch gets a copy, which it uses to
+choose program lengths: each length is weighted by the estimated
+probability that a program of that length falls into a stratum that
+isn't full yet (estimated from the strata of all programs seen so far).
+"""
+
+import bisect
+from collections import Counter
+from typing import Optional
+import numpy as np
+
+from rasp_gen.dataset.config import DatasetConfig
+
+
+class StratifiedQuotas:
+    def __init__(
+        self,
+        lengths: list[int],
+        layer_bins: tuple[int, ...],
+        quota: Optional[int] = None,
+        quotas: Optional[dict[tuple[int, int], int]] = None,
+    ):
+        """
+        Args:
+            lengths: program lengths (n_sops) to sample.
+            layer_bins: upper edges of the layer buckets; bucket i holds
+                n_layers in (layer_bins[i-1], layer_bins[i]], and the last
+                bucket everything above layer_bins[-1].
+            quota: quota of every stratum not in quotas (None = unlimited).
+            quotas: quotas of individual strata (n_sops, bucket).
+        """
+        self.lengths = list(lengths)
+        self.layer_bins = tuple(layer_bins)
+        self.quota = quota
+        self.quotas = dict(quotas or {})
+        self.counts = Counter()  # saved datapoints per stratum
+        self.seen = Counter()  # all datapoints per stratum, for steering
+
+    @classmethod
+    def from_config(cls, config: DatasetConfig):
+        """Return quotas for config, or None if it sets none."""
+        if config.stratum_quota is None and not config.stratum_quotas:
+            return None
+        return cls(np.atleast_1d(config.program_length).tolist(),
+                   config.layer_bins, quota=config.stratum_quota,
+                   quotas=config.stratum_quotas)
+
+    @property
+    def n_buckets(self) -> int:
+        return len(self.layer_bins) + 1
+
+    def stratum(self, datapoint: dict) -> tuple[int, int]:
+        bucket = bisect.bisect_left(self.layer_bins, datapoint["n_layers"])
+        return (int(datapoint["n_sops"]), bucket)
+
+    def remaining(self, stratum: tuple[int, int]) -> float:
+        quota = self.quotas.get(stratum, self.quota)
+        if quota is None:
+            return np.inf
+        return quota - self.counts[stratum]
+
+    def is_full(self, stratum: tuple[int, int]) -> bool:
+        return self.remaining(stratum) <= 0
+
+    @property
+    def full(self) -> bool:
+        """True if every stratum of self.lengths is full."""
+        return all(self.is_full((n, b)) for n in self.lengths
+                   for b in range(self.n_buckets))
+
+    def add(self, datapoint: dict) -> bool:
+        """Count a datapoint towards its stratum. Returns False (and
+        doesn't count it) if the stratum is already full."""
+        stratum = self.stratum(datapoint)
+        self.seen[stratum] += 1
+        if self.is_full(stratum):
+            return False
+        self.counts[stratum] += 1
+        return True
+
+    def length_weights(self) -> np.ndarray:
+        """Unnormalized weights of self.lengths: the probability that a
+        program of each length falls into a stratum that isn't full,
+        with add-one smoothing over the layer buckets."""
+        weights = []
+        for n in self.lengths:
+            seen = np.array([self.seen[(n, b)] for b in range(self.n_buckets)])
+            not_full = np.array([not self.is_full((n, b))
+                                 for b in range(self.n_buckets)])
+            smoothed = (seen + 1) / (seen.sum() + self.n_buckets)
+            weights.append((smoothed * not_full).sum())
+        return np.array(weights)
+
+    def sample_length(self, rng: np.random.Generator) -> int:
+        weights = self.length_weights()
+        if weights.sum() == 0:
+            weights = np.ones(len(self.lengths))
+        return int(rng.choice(self.lengths, p=weights / weights.sum()))
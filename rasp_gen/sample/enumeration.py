@@ -0,0 +1,230 @@
+# Enumerate every program up to a given length that the Sampler could
+# produce, instead of sampling them at random. SOps are built bottom-up,
+# one length at a time, from the SOps of shorter length, following the
+# same type rules as the Sampler (see sample.Sampler.add_map etc.).
+# Symmetric duplicates are pruned:
+# - SOps are keyed by their structural hash, which ignores labels, so
+#   programs that only differ by variable names are built once.
+# - SequenceMaps whose function is symmetric on the value sets of their
+#   arguments, and LinearSequenceMaps, are only built with their
+#   arguments in one order.
+# The number of programs grows very quickly with length, so this is
+# meant for lengths up to about 4.
+
+
+from time import time
+from typing import Iterator, Optional
+from tracr.rasp import rasp
+
+from rasp_gen.sample import map_primitives
+from rasp_gen.sample import rasp_utils
+from rasp_gen.sample import sample
+from rasp_gen.sample import value_sets
+from rasp_gen.sample.evaluate import MemoizedEvaluator
+from rasp_gen.sample.rasp_utils import SamplingError, annotate_type
+from rasp_gen.sample.telemetry import SamplingTelemetry
+from rasp_gen.sample.validate import perform_checks
+
+
+class Enumerator:
+    """Builds all distinct SOps of length up to max_length (counting
+    tokens and indices, as in Sampler.past) that satisfy the Sampler's
+    constraints, in canonical order: by length, then by op class and
+    arguments. The SOps are stored in self.sops, with the same per-SOp
+    lists as the Sampler (past, types, value sets, and none_free).
+    """
+    def __init__(self, max_length: int, only_categorical: bool = False):
+        self.max_length = max_length
+        self.only_categorical = only_categorical
+        self.sops: list[rasp.SOp] = []
+        self.past: list[frozenset[int]] = []
+        self.types: list[str] = []
+        self.values: list[set | None] = []
+        self.none_free: list[bool] = []
+        self.index_by_hash: dict[bytes, int] = {}
+        self.evaluator = MemoizedEvaluator()
+        self._add(annotate_type(rasp.tokens, "categorical"), [])
+        self._add(annotate_type(rasp.indices, "categorical"), [])
+        for length in range(2, max_length + 1):
+            self._extend(length)
+
+    def _add(self, sop: rasp.SOp, args: list[int]) -> bool:
+        """Add a (type-annotated) SOp built on self.sops[args], unless it
+        is a duplicate or returns None too often on the test inputs."""
+        sop_hash = rasp_utils.structural_hash(sop)
+        if sop_hash in self.index_by_hash:
+            return False
+        outputs = [self.evaluator.evaluate(sop, x) for x in sample.TEST_INPUTS]
+        if any(rasp_utils.fraction_none(out) > 0.5 for out in outputs):
+            return False
+        idx = len(self.sops)
+        self.index_by_hash[sop_hash] = idx
+        self.sops.append(sop)
+        self.past.append(frozenset({idx}).union(*(self.past[a] for a in args)))
+        self.types.append(sop.annotations["type"])
+        self.values.append(value_sets.value_set(
+            sop, [self.values[a] for a in args],
+            max_size=sample.MAX_VALUE_SET_SIZE, exact_means=True))
+        self.none_free.append(not any(None in out for out in outputs))
+        return True
+
+    def _arg_tuples(
+        self,
+        pools: list[list[int]],
+        length: int,
+    ) -> Iterator[tuple[int, ...]]:
+        """Tuples of indices, one from each pool, whose programs together
+        have length - 1 SOps (so that an op on them has the given length)."""
+        def extend(chosen: tuple[int, ...], past: frozenset[int]):
+            if len(chosen) == len(pools):
+                if len(past) == length - 1:
+                    yield chosen
+                return
+            for i in pools[len(chosen)]:
+                union = past | self.past[i]
+                if len(union) < length:
+                    yield from extend(chosen + (i,), union)
+        yield from extend((), frozenset())
+
+    def _extend(self, length: int):
+        """Add all SOps of the given length."""
+        shorter = range(len(self.sops))
+        def pool(type: str, none_free: bool = False) -> list[int]:
+            return [i for i in shorter if self.types[i] == type
+                    and (self.none_free[i] or not none_free)]
+        categorical = pool("categorical")
+        selector_args = pool("categorical", none_free=True)
+
+        for (i,) in self._arg_tuples([list(shorter)], length):
+            self._add_maps(i)
+        for i, j in self._arg_tuples([categorical, categorical], length):
+            self._add_sequence_maps(i, j)
+        if not self.only_categorical:
+            floats = pool("float")
+            for i, j in self._arg_tuples([floats, floats], length):
+                self._add_linear_sequence_maps(i, j)
+        for k, q in self._arg_tuples([selector_args, selector_args], length):
+            for select in self._selects(k, q, allow_select_all=True):
+                self._add(annotate_type(rasp.SelectorWidth(select),
+                                        "categorical"), [k, q])
+        aggregated = [("categorical", selector_args)]
+        if not self.only_categorical:
+            aggregated.append(("bool", pool("bool", none_free=True)))
+        for type, sops_in in aggregated:
+            pools = [selector_args, selector_args, sops_in]
+            for k, q, i in self._arg_tuples(pools, length):
+                self._add_aggregates(k, q, i, type)
+
+    def _add_maps(self, i: int):
+        input_type = self.types[i]
+        if input_type == "float" and isinstance(self.sops[i], rasp.Aggregate):
+            input_type = "freq"  # see Sampler.add_map
+        output_types = (["categorical"] if self.only_categorical
+                        else map_primitives.TYPES)
+        for output_type in output_types:
+            for fn in map_primitives.FUNCTIONS_BY_SIGNATURE[
+                    f"{input_type} --> {output_type}"]:
+                if (self.values[i] is not None and
+                        map_primitives.is_constant(fn, self.values[i])):
+                    continue
+                sop = rasp.Map(fn, self.sops[i], simplify=False)
+                self._add(annotate_type(sop, output_type), [i])
+
+    def _add_sequence_maps(self, i: int, j: int):
+        if i == j:
+            return
+        domains = [self.values[i], self.values[j]]
+        for fn in map_primitives.NONLINEAR_SEQMAP_FNS:
+            if None not in domains:
+                if map_primitives.is_constant(fn, *domains):
+                    continue
+                if i > j and is_symmetric(fn, *domains):
+                    continue  # same as SequenceMap(fn, sops[j], sops[i])
+            sop = rasp.SequenceMap(fn, self.sops[i], self.sops[j])
+            self._add(annotate_type(sop, "categorical"), [i, j])
+
+    def _add_linear_sequence_maps(self, i: int, j: int):
+        if i >= j:  # LinearSequenceMap(x, y, a, b) == (y, x, b, a)
+            return
+        for a in map_primitives.LINEAR_SEQUENCE_MAP_WEIGHTS:
+            for b in map_primitives.LINEAR_SEQUENCE_MAP_WEIGHTS:
+                sop = rasp.LinearSequenceMap(self.sops[i], self.sops[j], a, b)
+                self._add(annotate_type(sop, "float"), [i, j])
+
+    def _selects(self, k: int, q: int, allow_select_all: bool) -> list[rasp.Select]:
+        """Selects on keys sops[k] and queries sops[q], with the
+        predicates that Sampler.get_selector would sample."""
+        selects = []
+        for comparison in map_primitives.COMPARISONS:
+            if self.values[k] is not None and self.values[q] is not None:
+                selected = value_sets.predicate_values(
+                    comparison, self.values[k], self.values[q])
+                if not (True in selected and
+                        (allow_select_all or False in selected)):
+                    continue
+            selects.append(rasp.Select(self.sops[k], self.sops[q], comparison))
+        return selects
+
+    def _add_aggregates(self, k: int, q: int, i: int, type: str):
+        sop_in = self.sops[i]
+        for select in self._selects(k, q, allow_select_all=type == "bool"):
+            if type == "bool":
+                sop = rasp.Aggregate(select, sop_in, default=0)
+                self._add(annotate_type(sop, "float"), [k, q, i])
+                continue
+            sop = annotate_type(rasp.Aggregate(select, sop_in, default=None),
+                                "categorical")
+            # output domain constraint, as in Sampler.add_categorical_aggregate
+            if all(set(self.evaluator.evaluate(sop, x)) <=
+                   set(self.evaluator.evaluate(sop_in, x)) | {None}
+                   for x in sample.TEST_INPUTS):
+                self._add(sop, [k, q, i])
+
+    def programs(self, min_length: int = 2) -> Iterator[rasp.SOp]:
+        """All SOps of length at least min_length, in canonical order,
+        annotated with their length."""
+        for sop, past in zip(self.sops, self.past):
+            if len(past) >= max(min_length, 2):
+                yield rasp.annotate(sop, length=len(past))
+
+
+def is_symmetric(fn: map_primitives.FunctionWithRepr, xs: set, ys: set) -> bool:
+    """True if fn(x, y) == fn(y, x) for all x in xs and y in ys (where
+    both orders are defined)."""
+    for x in xs:
+        for y in ys:
+            try:
+                if fn.lookup(x, y) != fn.lookup(y, x):
+                    return False
+            except ArithmeticError:
+                return False
+    return True
+
+
+def enumerate_programs(
+    max_length: int,
+    min_length: int = 2,
+    worker: int = 0,
+    n_workers: int = 1,
+    telemetry: Optional[SamplingTelemetry] = None,
+    **enumerator_kwargs,
+) -> Iterator[rasp.SOp]:
+    """Yield every program of length min_length to max_length that passes
+    perform_checks, in canonical order. With n_workers > 1, only every
+    n_workers-th program starting from worker is checked and yielded, so
+    that the workers together cover all programs exactly once. (Each
+    worker builds the same Enumerator, which is cheap compared to the
+    checks.)"""
+    telemetry = telemetry if telemetry is not None else SamplingTelemetry()
+    enumerator = Enumerator(max_length, **enumerator_kwargs)
+    for n, program in enumerate(enumerator.programs(min_length)):
+        if n % n_workers != worker:
+            continue
+        start = time()
+        try:
+            perform_checks(program, sample.CHECK_INPUTS)
+        except SamplingError as e:
+            telemetry.record("enumerate", time() - start, reason=e.reason)
+            continue
+        telemetry.record("enumerate", time() - start)
+        yield program
@@ -0,0 +1,198 @@
+from typing import Sequence
+import numpy as np
+from tracr.rasp import rasp
+
+from rasp_gen.sample.map_primitives import FunctionWithRepr
+from rasp_gen.sample.map_primitives import to_python, from_python
+
+
+class MemoizedEvaluator(rasp.DefaultRASPEvaluator):
+    """RASP evaluator that caches the outputs of every expression it
+    evaluates, keyed by (expr.label, input). Since the default evaluator
+    recurses through self.evaluate, a new expression is evaluated from
+    the cached outputs of its children instead of re-walking the DAG.
+
+    Labels are unique per expression (annotated copies share the label
+    of the original, but evaluate identically), so the cache is safe to
+    share between all SOps built by one Sampler.
+
+    Map and SequenceMap functions that are FunctionWithRepr primitives
+    are applied through their memoized lookup (FunctionWithRepr.lookup).
+    """
+    def __init__(self):
+        super().__init__()
+        self.cache: dict[tuple[str, tuple], list] = {}
+
+    def evaluate(self, expr: rasp.RASPExpr, xs: Sequence[rasp.Value]):
+        key = (expr.label, tuple(xs))
+        if key not in self.cache:
+            self.cache[key] = super().evaluate(expr, xs)
+        return self.cache[key]
+
+    def eval_map(self, sop: rasp.Map, xs: Sequence[rasp.Value]):
+        if not isinstance(sop.f, FunctionWithRepr):
+            return super().eval_map(sop, xs)
+        f = sop.f.lookup
+        return [None if x is None else f(x)
+                for x in self.evaluate(sop.inner, xs)]
+
+    def eval_sequence_map(self, sop: rasp.SequenceMap, xs: Sequence[rasp.Value]):
+        if not isinstance(sop.f, FunctionWithRepr):
+            return super().eval_sequence_map(sop, xs)
+        f = sop.f.lookup
+        return [None if x is None or y is None else f(x, y) for x, y in 
+                zip(self.evaluate(sop.fst, xs), self.evaluate(sop.snd, xs))]
+
+
+# Batched evaluation
+# SOp values on a batch of N inputs are stored as (N, L) float arrays, 
+# where L is the length of the longest input. None and padding are both
+# represented by NaN. Selectors are (N, L, L) boolean arrays, indexed as
+# [batch, query, key].
+
+COMPARISONS = {
+    rasp.Comparison.EQ: np.equal,
+    rasp.Comparison.LT: np.less,
+    rasp.Comparison.LEQ: np.less_equal,
+    rasp.Comparison.GT: np.greater,
+    rasp.Comparison.GEQ: np.greater_equal,
+    rasp.Comparison.NEQ: np.not_equal,
+    rasp.Comparison.TRUE: lambda key, query: np.ones(
+        np.broadcast_shapes(key.shape, query.shape), dtype=bool),
+    rasp.Comparison.FALSE: lambda key, query: np.zeros(
+        np.broadcast_shapes(key.shape, query.shape), dtype=bool),
+}
+
+
+def pad_inputs(inputs: Sequence[Sequence[int]]) -> tuple[np.ndarray, np.ndarray]:
+    """Pad a list of input sequences to a (N, max_len) integer array.
+    Returns the padded array and the (N,) array of sequence lengths."""
+    inputs = list(inputs)
+    lengths = np.array([len(x) for x in inputs])
+    tokens = np.zeros((len(inputs), lengths.max()), dtype=int)
+    for i, x in enumerate(inputs):
+        tokens[i, :len(x)] = x
+    return tokens, lengths
+
+
+class BatchedEvaluator:
+    """Evaluate RASP programs on a padded batch of inputs at once.
+    Map and SequenceMap are applied through lookup tables over the distinct
+    values that occur in the batch (FunctionWithRepr.table for primitives,
+    which is cached across batches), so the Python function is called at
+    most once per distinct value instead of once per element.
+
+    Inputs on which tracr's evaluator would raise a ValueError are flagged
+    in self.none_in_select and self.none_in_aggregate instead.
+    """
+    def __init__(self, tokens: np.ndarray, lengths: np.ndarray):
+        n, max_len = tokens.shape
+        self.lengths = np.asarray(lengths)
+        self.mask = np.arange(max_len)[None, :] < self.lengths[:, None]
+        self.tokens = np.where(self.mask, tokens, np.nan)
+        self.indices = np.where(
+            self.mask, np.arange(max_len, dtype=float)[None, :], np.nan)
+        self.none_in_select = np.zeros(n, dtype=bool)
+        self.none_in_aggregate = np.zeros(n, dtype=bool)
+        self.cache: dict[str, np.ndarray] = {}
+
+    @classmethod
+    def from_inputs(cls, inputs: Sequence[Sequence[int]]):
+        return cls(*pad_inputs(inputs))
+
+    @property
+    def errors(self) -> np.ndarray:
+        """(N,) boolean array, True where evaluation would raise."""
+        return self.none_in_select | self.none_in_aggregate
+
+    def evaluate(self, expr: rasp.RASPExpr) -> np.ndarray:
+        if expr.label not in self.cache:
+            self.cache[expr.label] = self._evaluate(expr)
+        return self.cache[expr.label]
+
+    def _evaluate(self, expr: rasp.RASPExpr) -> np.ndarray:
+        if isinstance(expr, rasp.TokensType):
+            return self.tokens
+        elif isinstance(expr, rasp.IndicesType):
+            return self.indices
+        elif isinstance(expr, rasp.Map):
+            return apply_elementwise(expr.f, self.evaluate(expr.inner))
+        elif isinstance(expr, rasp.LinearSequenceMap):
+            return (expr.fst_fac * self.evaluate(expr.fst) + 
+                    expr.snd_fac * self.evaluate(expr.snd))
+        elif isinstance(expr, rasp.SequenceMap):
+            return apply_elementwise(
+                expr.f, self.evaluate(expr.fst), self.evaluate(expr.snd))
+        elif isinstance(expr, rasp.Select):
+            return self._eval_select(expr)
+        elif isinstance(expr, rasp.Aggregate):
+            return self._eval_aggregate(expr)
+        elif isinstance(expr, rasp.SelectorWidth):
+            width = self.evaluate(expr.selector).sum(axis=-1)
+            return np.where(self.mask, width, np.nan)
+        else:
+            raise ValueError(f"Unknown expression type {type(expr)}.")
+
+    def _eval_select(self, sel: rasp.Select) -> np.ndarray:
+        if sel.predicate not in COMPARISONS:
+            raise ValueError(f"Unsupported predicate {sel.predicate}.")
+        keys = self.evaluate(sel.keys)
+        queries = self.evaluate(sel.queries)
+        self.none_in_select |= (
+            (np.isnan(keys) | np.isnan(queries)) & self.mask).any(axis=-1)
+        selected = COMPARISONS[sel.predicate](
+            keys[:, None, :], queries[:, :, None])
+        return selected & self.mask[:, :, None] & self.mask[:, None, :]
+
+    def _eval_aggregate(self, agg: rasp.Aggregate) -> np.ndarray:
+        selector = self.evaluate(agg.selector)
+        values = self.evaluate(agg.sop)
+        is_none = np.isnan(values)
+        width = selector.sum(axis=-1)
+        none_selected = (selector & is_none[:, None, :]).any(axis=-1)
+        total = (selector * np.where(is_none, 0., values)[:, None, :]).sum(-1)
+        mean = total / np.maximum(width, 1)
+        default = np.nan if agg.default is None else float(agg.default)
+
+        # tracr's mean returns the default if nothing is selected and the
+        # selected value as is if there is exactly one (even if it is
+        # None). It only raises ("Only types int, bool, and float are
+        # supported for aggregation") when averaging over several values
+        # that include a None:
+        self.none_in_aggregate |= (none_selected & (width > 1)).any(axis=-1)
+        out = np.where(none_selected, np.nan, mean)
+        out = np.where(width == 0, default, out)
+        return np.where(self.mask, out, np.nan)
+
+
+def apply_elementwise(f: callable, *args: np.ndarray) -> np.ndarray:
+    """Apply f elementwise to one or more (N, L) arrays through a lookup
+    table over the distinct values of each argument. Positions where
+    any argument is None (NaN) are None in the output."""
+    defined = np.all([~np.isnan(a) for a in args], axis=0)
+    out = np.full(args[0].shape, np.nan)
+    if not defined.any():
+        return out
+    if isinstance(f, FunctionWithRepr):
+        domains, indices = zip(*[
+            np.unique(a[defined], return_inverse=True) for a in args])
+        try:
+            out[defined] = f.table(*domains)[indices]
+            return out
+        except ArithmeticError:
+            pass  # maybe only on combinations that don't occur in the batch
+    keys = np.stack([a[defined] for a in args], axis=-1)
+    distinct, inverse = np.unique(keys, axis=0, return_inverse=True)
+    table = np.array(
+        [from_python(f(*[to_python(v) for v in row])) for row in distinct],
+        dtype=float,
+    )
+    out[defined] = table[inverse.reshape(-1)]
+    return out
+
+
+def evaluate_batch(program: rasp.SOp, inputs: Sequence[Sequence[int]]
+                   ) -> np.ndarray:
+    """Evaluate a program on a list of inputs. Returns a NaN-padded array
+    of shape (len(inputs), max_len)."""
+    return BatchedEvaluator.from_inputs(inputs).evaluate(program)
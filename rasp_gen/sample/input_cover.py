@@ -0,0 +1,230 @@
+# Choose a small set of test inputs for perform_checks that makes the same
+# decisions (reject or accept) as the exhaustive input space on a corpus
+# of sampled programs. Most checks reject a program if any single input
+# triggers them (Nones in Select or Aggregate, too many Nones, dynamic
+# validation), or if no input tells the program apart from the identity,
+# so preserving them is a set cover problem over the inputs, which we
+# solve greedily. The constant check depends on the spread of the outputs
+# over all inputs of the most common length instead; it is fixed up
+# afterwards by greedily adding inputs of length max_seq_len. Finally,
+# inputs are added until the chosen set accepts no program that all
+# inputs reject. See scripts/select_check_inputs.py.
+
+
+from collections import defaultdict
+from dataclasses import dataclass
+import itertools
+import numpy as np
+from tracr.rasp import rasp
+
+from rasp_gen.sample import sample
+from rasp_gen.sample.evaluate import BatchedEvaluator
+from rasp_gen.sample.rasp_utils import SamplingError
+from rasp_gen.sample.validate import dynamic_validate, is_constant
+from rasp_gen.dataset.logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+
+# is_constant only compares outputs if there are at least this many
+MIN_CONSTANT_INPUTS = 10
+
+
+def all_inputs(
+    vocab: set = frozenset(range(5)),
+    max_seq_len: int = 5,
+) -> list[tuple[int, ...]]:
+    """All inputs of length 1 to max_seq_len, shortest first."""
+    return [x for n in range(1, max_seq_len + 1)
+            for x in itertools.product(sorted(vocab), repeat=n)]
+
+
+def sample_candidates(
+    rng: np.random.Generator,
+    program_length: int,
+    max_retries: int = 5,
+) -> rasp.SOp:
+    """Sample a program like sample.sample, but return it before
+    perform_checks, so that programs the checks reject are included."""
+    sampler = sample.Sampler(rng)
+    avoid = set()
+    retries = defaultdict(int)
+    while sampler.current_length() != program_length:
+        try:
+            avoid = sampler.try_to_add_sop(avoid)
+        except SamplingError:
+            if not sample.backtrack(sampler, retries, max_retries,
+                                    program_length):
+                sampler = sample.Sampler(rng)
+                retries.clear()
+            avoid = set()
+    return sampler.scope[-1]
+
+
+@dataclass
+class CheckWitnesses:
+    """Per-input outcomes of perform_checks for one program on a set of
+    inputs (all arrays are indexed by input).
+    - rejects: the input on its own makes perform_checks reject the
+        program (Nones in Select or Aggregate, too many Nones, or
+        failing dynamic validation).
+    - not_identity: the output differs from the input.
+    - outputs: NaN-padded outputs, and lengths of the inputs, as used
+        by the constant check.
+    - rejected: the decision of perform_checks on all inputs.
+    """
+    rejects: np.ndarray
+    not_identity: np.ndarray
+    outputs: np.ndarray
+    lengths: np.ndarray
+    rejected: bool
+
+
+def check_witnesses(
+    program: rasp.SOp,
+    inputs: list[tuple[int, ...]],
+) -> CheckWitnesses:
+    """Evaluate program on all inputs at once and record, for every input,
+    which checks of perform_checks it triggers."""
+    evaluator = BatchedEvaluator.from_inputs(inputs)
+    outputs = evaluator.evaluate(program)
+    mask = evaluator.mask
+    nones = (np.isnan(outputs) & mask).sum(axis=1)
+    rejects = (evaluator.errors | (nones / evaluator.lengths > 0.5)
+               | dynamic_validate(program, evaluator))
+    differs = (outputs != evaluator.tokens) & mask  # NaN != x
+    not_identity = differs.any(axis=1)
+    rejected = (rejects.any() or not not_identity.any()
+                or is_constant(outputs, evaluator.lengths))
+    return CheckWitnesses(rejects=rejects, not_identity=not_identity,
+                          outputs=outputs, lengths=evaluator.lengths,
+                          rejected=bool(rejected))
+
+
+class InputCover:
+    """Greedily chooses inputs so that perform_checks makes the same
+    decisions on a corpus of programs as with all inputs."""
+    def __init__(
+        self,
+        inputs: list[tuple[int, ...]],
+        witnesses: list[CheckWitnesses],
+    ):
+        self.inputs = inputs
+        self.target = np.array([w.rejected for w in witnesses])
+        self.rejects = np.stack([w.rejects for w in witnesses])
+        self.not_identity = np.stack([w.not_identity for w in witnesses])
+        self.outputs = np.nan_to_num(
+            np.stack([w.outputs for w in witnesses]), nan=0)
+        self.lengths = witnesses[0].lengths
+        self.max_seq_len = self.outputs.shape[-1]
+        self.chosen: list[int] = []
+
+    def decisions(self, chosen: list[int] | None = None) -> np.ndarray:
+        """Decisions of perform_checks restricted to the chosen inputs,
+        for every program in the corpus (True means rejected)."""
+        chosen = self.chosen if chosen is None else chosen
+        chosen = np.array(chosen, dtype=int)
+        if len(chosen) == 0:
+            return np.zeros(len(self.target), dtype=bool)
+        rejected = (self.rejects[:, chosen].any(axis=1) |
+                    ~self.not_identity[:, chosen].any(axis=1))
+        constant = [is_constant(o, self.lengths[chosen])
+                    for o in self.outputs[:, chosen]]
+        return rejected | np.array(constant)
+
+    def mismatches(self) -> int:
+        return int((self.decisions() != self.target).sum())
+
+    def cover(self):
+        """Choose inputs until every rejected program has an input that
+        rejects it and every accepted program has an input that tells it
+        apart from the identity (or until no input helps anymore).
+        Programs that are only rejected as constant are left to
+        fix_constant. Inputs that are already chosen count as well."""
+        chosen = np.array(self.chosen, dtype=int)
+        need_reject = (self.target & self.rejects.any(axis=1)
+                       & ~self.rejects[:, chosen].any(axis=1))
+        need_not_identity = ~self.target & ~self.not_identity[:, chosen].any(axis=1)
+        while True:
+            gain = (self.rejects[need_reject].sum(axis=0) +
+                    self.not_identity[need_not_identity].sum(axis=0))
+            best = int(np.argmax(gain))
+            if gain[best] == 0:
+                break
+            self.chosen.append(best)
+            need_reject &= ~self.rejects[:, best]
+            need_not_identity &= ~self.not_identity[:, best]
+        logger.info(f"Set cover: {len(self.chosen)} inputs, "
+                    f"{need_reject.sum()} rejections and "
+                    f"{need_not_identity.sum()} non-identities uncovered.")
+
+    def fix_constant(self, max_inputs: int = 100):
+        """Add inputs of length max_seq_len, so that this is the most
+        common length in the chosen set (which is the one is_constant
+        compares) and the constant check agrees with the target on as many
+        programs as possible. Each step adds the input that minimizes
+        the number of mismatches."""
+        candidates = np.setdiff1d(
+            np.flatnonzero(self.lengths == self.max_seq_len), self.chosen)
+        while len(self.chosen) < max_inputs:
+            counts = np.bincount(self.lengths[self.chosen],
+                                 minlength=self.max_seq_len + 1)
+            n_full = counts[self.max_seq_len]
+            required = (n_full < MIN_CONSTANT_INPUTS or
+                        n_full <= counts[:self.max_seq_len].max())
+            errors = self._constant_errors(candidates)
+            if not required and errors.min() >= self.mismatches():
+                break
+            best = int(candidates[np.argmin(errors)])
+            self.chosen.append(best)
+            candidates = candidates[candidates != best]
+        logger.info(f"Constant fix-up: {len(self.chosen)} inputs, "
+                    f"{self.mismatches()} mismatches left.")
+
+    def fix_false_accepts(self, max_inputs: int = 150):
+        """Add inputs until no program that all inputs reject is
+        accepted by the chosen inputs (as far as a single input can
+        reject it). Each step adds the input that rejects the most of
+        these false accepts."""
+        while len(self.chosen) < max_inputs:
+            false_accepts = self.target & ~self.decisions()
+            gain = self.rejects[false_accepts].sum(axis=0)
+            best = int(np.argmax(gain))
+            if gain[best] == 0:
+                break
+            self.chosen.append(best)
+        logger.info(f"False accept fix-up: {len(self.chosen)} inputs, "
+                    f"{(self.target & ~self.decisions()).sum()} false "
+                    f"accepts left.")
+
+    def _constant_errors(
+        self,
+        candidates: np.ndarray,
+        chunk_size: int = 256,
+    ) -> np.ndarray:
+        """Nr of mismatches after adding each candidate (of length
+        max_seq_len) to the chosen inputs, assuming max_seq_len stays the
+        most common length. Uses running sums to get the standard
+        deviation over the new set of inputs for all candidates at once."""
+        chosen = np.array(self.chosen, dtype=int)
+        full = chosen[self.lengths[chosen] == self.max_seq_len]
+        n = len(full) + 1
+        s1 = self.outputs[:, full].sum(axis=1)[:, None]  # (programs, 1, len)
+        s2 = (self.outputs[:, full]**2).sum(axis=1)[:, None]
+        rejected = self.rejects[:, chosen].any(axis=1)[:, None]
+        not_identity = self.not_identity[:, chosen].any(axis=1)[:, None]
+
+        errors = []
+        for i in range(0, len(candidates), chunk_size):
+            c = candidates[i:i + chunk_size]
+            x = self.outputs[:, c]  # (programs, candidates, len)
+            var = (s2 + x**2) / n - ((s1 + x) / n)**2
+            std = np.sqrt(np.maximum(var, 0)).sum(axis=-1)
+            constant = (std < 0.5) & (n >= MIN_CONSTANT_INPUTS)
+            decisions = (rejected | self.rejects[:, c] | constant |
+                         ~(not_identity | self.not_identity[:, c]))
+            errors.append((decisions != self.target[:, None]).sum(axis=0))
+        return np.concatenate(errors)
+
+    def chosen_inputs(self) -> list[tuple[int, ...]]:
+        return [self.inputs[i] for i in self.chosen]
@@ -21,17 +21,47 @@
 # - numerical values are not allowed to be negative (because of ReLU)
 
 
+import itertools
+import numpy as np
 from tracr.rasp import rasp
 
 
+# Lookup tables are cached per function (and domain). Clear a cache once
+# it holds this many entries: domains depend on the inputs a program is
+# evaluated on, so they're not bounded in general.
+MAX_VALUES_PER_FN = 2**16
+MAX_TABLES_PER_FN = 2**10
+
+
 class FunctionWithRepr:
     """Minimal wrapper around a function that allows to 
-    represent it as a string."""
-    def __init__(self, fn_str: str):
+    represent it as a string.
+    Instances are interned by fn_str: FunctionWithRepr(s) returns the same
+    object every time, so the string is only eval'd once (detokenizing 
+    creates one per Map and SequenceMap) and equality is identity.
+
+    All primitives act on small, finite sets of values, so instead of
+    calling fn once per element, evaluators use lookup tables:
+    - self.lookup(*args) memoizes fn per (typed) argument tuple.
+    - self.table(*domains) returns a float array over the product of
+      the domains, for batched evaluation with numpy indexing.
+    self(*args) calls fn directly and remains the fallback."""
+    __slots__ = ("fn_str", "fn", "_hash", "_values", "_tables")
+    _registry: dict[str, "FunctionWithRepr"] = {}
+
+    def __new__(cls, fn_str: str):
         """
         fn_str: function in form of eval-able string, e.g. 'lambda x: x+1'."""
-        self.fn_str = fn_str
-        self.fn = eval(fn_str)
+        self = cls._registry.get(fn_str)
+        if self is None:
+            self = super().__new__(cls)
+            self.fn_str = fn_str
+            self.fn = eval(fn_str)
+            self._hash = hash(fn_str)
+            self._values = {}
+            self._tables = {}
+            cls._registry[fn_str] = self
+        return self
 
     def __repr__(self):
         return self.fn_str
@@ -39,12 +69,60 @@ class FunctionWithRepr:
     def __call__(self, *args, **kwargs):
         return self.fn(*args, **kwargs)
     
+    def lookup(self, *args):
+        """Same as self(*args), but memoized. The key includes the
+        argument types, since e.g. True == 1 but (lambda x: x)(True)
+        is not the same value as (lambda x: x)(1)."""
+        key = (*args, *map(type, args))
+        try:
+            return self._values[key]
+        except KeyError:
+            if len(self._values) >= MAX_VALUES_PER_FN:
+                self._values.clear()
+            out = self._values[key] = self.fn(*args)
+            return out
+
+    def table(self, *domains: np.ndarray) -> np.ndarray:
+        """Lookup table over the product of the domains (one 1D float
+        array of values per argument): table[i, j] = self(x[i], y[j]) 
+        for x, y = domains. None outputs are NaN. Cached per domain."""
+        key = tuple(d.tobytes() for d in domains)
+        table = self._tables.get(key)
+        if table is None:
+            args = [[to_python(v) for v in d] for d in domains]
+            table = np.array(
+                [from_python(self.lookup(*xs)) for xs in itertools.product(*args)],
+                dtype=float,
+            ).reshape([len(d) for d in domains])
+            if len(self._tables) >= MAX_TABLES_PER_FN:
+                self._tables.clear()
+            self._tables[key] = table
+        return table
+
     def compose(self, other: "FunctionWithRepr"):
         """Compose two functions."""
         return FunctionWithRepr(f"(lambda x: {self.fn_str})(({other.fn_str})(x))")
     
     def __eq__(self, other):
-        return self.fn_str == other.fn_str
+        return self is other or (isinstance(other, FunctionWithRepr) 
+                                 and self.fn_str == other.fn_str)
+
+    def __hash__(self):
+        return self._hash
+
+    def __reduce__(self):  # re-intern on unpickling / copying
+        return (FunctionWithRepr, (self.fn_str,))
+
+
+def to_python(x: np.floating) -> int | float:
+    """Convert an array value back to the int / float RASP value."""
+    x = float(x)
+    return int(x) if x.is_integer() else x
+
+
+def from_python(x) -> float:
+    """Convert a RASP value to an array value (None becomes NaN)."""
+    return np.nan if x is None else float(x)
 
 
 TYPES = [
@@ -176,11 +254,38 @@ FUNCTIONS_BY_SIGNATURE = {
 }
 
 
-def get_map_fn(rng, input_type: str, output_types=TYPES) -> tuple[callable, str]:
+def is_constant(fn: FunctionWithRepr, *domains: set) -> bool:
+    """True if fn takes at most one value on the product of the domains
+    (value sets of its arguments)."""
+    outputs = set()
+    for xs in itertools.product(*domains):
+        outputs.add(fn.lookup(*xs))
+        if len(outputs) > 1:
+            return False
+    return True
+
+
+def get_map_fn(
+    rng,
+    input_type: str,
+    output_types=TYPES,
+    domain: set = None,
+) -> tuple[callable, str]:
     """
     Randomly determine an output domain (ie type), then sample a function
     from the set of functions that map from input_type --> output_type.
+    If the domain (value set of the input) is given, only functions that 
+    are not constant on it are sampled. Returns (None, None) if there
+    are none.
     """
-    output_type = rng.choice(output_types)
-    fn_scope = FUNCTIONS_BY_SIGNATURE[f"{input_type} --> {output_type}"]
-    return rng.choice(fn_scope), output_type
+    fns_by_type = {}
+    for output_type in output_types:
+        fns = FUNCTIONS_BY_SIGNATURE[f"{input_type} --> {output_type}"]
+        if domain is not None:
+            fns = [fn for fn in fns if not is_constant(fn, domain)]
+        if fns:
+            fns_by_type[output_type] = fns
+    if not fns_by_type:
+        return None, None
+    output_type = rng.choice(list(fns_by_type))
+    return rng.choice(fns_by_type[output_type]), output_type
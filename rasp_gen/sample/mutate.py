@@ -0,0 +1,184 @@
+# Generate programs by applying a local edit to an existing program
+# (e.g. one from programs.h5, via tokenizer.detokenize):
+# - function: swap the function of a Map or SequenceMap for another one
+#   with the same signature (see map_primitives.FUNCTIONS_BY_SIGNATURE),
+#   or the weights of a LinearSequenceMap
+# - predicate: change the comparison of the Select of an Aggregate or
+#   SelectorWidth
+# - rewire: replace one argument of a SOp by another SOp of the same type
+#   that comes before it in the program
+# Mutants are checked with perform_checks like sampled programs.
+
+
+from time import time
+from typing import Optional
+import numpy as np
+from tracr.rasp import rasp
+
+from rasp_gen.sample import map_primitives
+from rasp_gen.sample import rasp_utils
+from rasp_gen.sample import sample
+from rasp_gen.sample import value_sets
+from rasp_gen.sample.rasp_utils import SamplingError
+from rasp_gen.sample.telemetry import SamplingTelemetry
+from rasp_gen.sample.validate import perform_checks
+
+
+def infer_types(
+    order: list[rasp.SOp],
+) -> tuple[dict[str, str], dict[str, set | None]]:
+    """Return the sampler types (categorical, bool, or float) and value
+    sets of the SOps in order (a topological order), keyed by label.
+    Detokenized programs only have encodings, so numerical SOps are
+    bools if their value set is a subset of {0, 1}."""
+    types, values = {}, {}
+    for sop in order:
+        children = [values[x.label] for x in rasp_utils.sop_args(sop)]
+        values[sop.label] = value_sets.value_set(
+            sop, children, max_size=sample.MAX_VALUE_SET_SIZE,
+            exact_means=True)
+        if rasp.is_categorical(sop):
+            types[sop.label] = "categorical"
+        elif values[sop.label] is not None and values[sop.label] <= {0, 1}:
+            types[sop.label] = "bool"
+        else:
+            types[sop.label] = "float"
+    return types, values
+
+
+def rebuild(sop: rasp.SOp, args: list[rasp.SOp], type: str, **changes) -> rasp.SOp:
+    """Build a SOp like sop, but on args (in the order of
+    rasp_utils.sop_args) and with the fields in changes (f, weights, or
+    predicate) replaced. Keeps the encoding of sop."""
+    if isinstance(sop, (rasp.Aggregate, rasp.SelectorWidth)):
+        predicate = changes.get("predicate", sop.selector.predicate)
+        select = rasp.Select(args[0], args[1], predicate)
+    if isinstance(sop, rasp.Map):
+        out = rasp.Map(changes.get("f", sop.f), args[0], simplify=False)
+    elif isinstance(sop, rasp.LinearSequenceMap):
+        weights = changes.get("weights", (sop.fst_fac, sop.snd_fac))
+        out = rasp.LinearSequenceMap(*args, *weights)
+    elif isinstance(sop, rasp.SequenceMap):
+        out = rasp.SequenceMap(changes.get("f", sop.f), *args)
+    elif isinstance(sop, rasp.Aggregate):
+        out = rasp.Aggregate(select, args[2], default=sop.default)
+    elif isinstance(sop, rasp.SelectorWidth):
+        out = rasp.SelectorWidth(select)
+    else:
+        raise ValueError(f"Unsupported SOp: {sop}")
+    out = rasp.numerical(out) if rasp.is_numerical(sop) else rasp.categorical(out)
+    return rasp.annotate(out, type=type)
+
+
+def replace(
+    program: rasp.SOp,
+    order: list[rasp.SOp],
+    old: rasp.SOp,
+    new: rasp.SOp,
+    types: dict[str, str],
+) -> rasp.SOp:
+    """Replace old by new in program, rebuilding every SOp downstream."""
+    rebuilt = {old.label: new}
+    for sop in order:
+        args = rasp_utils.sop_args(sop)
+        if any(arg.label in rebuilt for arg in args):
+            args = [rebuilt.get(arg.label, arg) for arg in args]
+            rebuilt[sop.label] = rebuild(sop, args, types[sop.label])
+    return rebuilt.get(program.label, program)
+
+
+def mutate_function(rng, sop, order, types, values) -> rasp.SOp | None:
+    args = rasp_utils.sop_args(sop)
+    domains = [values[arg.label] for arg in args]
+    if isinstance(sop, rasp.Map):
+        input_type = types[args[0].label]
+        if (input_type == "float" and isinstance(args[0], rasp.Aggregate)):
+            input_type = "freq"  # see Sampler.add_map
+        fns = map_primitives.FUNCTIONS_BY_SIGNATURE[
+            f"{input_type} --> {types[sop.label]}"]
+    elif isinstance(sop, rasp.LinearSequenceMap):
+        weights = [(a, b) for a in map_primitives.LINEAR_SEQUENCE_MAP_WEIGHTS
+                   for b in map_primitives.LINEAR_SEQUENCE_MAP_WEIGHTS
+                   if (a, b) != (sop.fst_fac, sop.snd_fac)]
+        a, b = weights[rng.choice(len(weights))]
+        return rebuild(sop, args, types[sop.label], weights=(a, b))
+    elif isinstance(sop, rasp.SequenceMap):
+        fns = map_primitives.NONLINEAR_SEQMAP_FNS
+    else:
+        return None
+    fns = [fn for fn in fns if repr(fn) != repr(sop.f) and (
+           None in domains or not map_primitives.is_constant(fn, *domains))]
+    if not fns:
+        return None
+    return rebuild(sop, args, types[sop.label], f=fns[rng.choice(len(fns))])
+
+
+def mutate_predicate(rng, sop, order, types, values) -> rasp.SOp | None:
+    if not isinstance(sop, (rasp.Aggregate, rasp.SelectorWidth)):
+        return None
+    comparisons = [c for c in map_primitives.COMPARISONS
+                   if c != sop.selector.predicate]
+    comparison = comparisons[rng.choice(len(comparisons))]
+    return rebuild(sop, rasp_utils.sop_args(sop), types[sop.label],
+                   predicate=comparison)
+
+
+def rewire(rng, sop, order, types, values) -> rasp.SOp | None:
+    args = rasp_utils.sop_args(sop)
+    i = rng.choice(len(args))
+    # SOps before sop in topological order don't depend on it. (Find sop
+    # by label, since SOp.__eq__ builds a Map instead of comparing.)
+    position = next(n for n, x in enumerate(order) if x.label == sop.label)
+    before = order[:position]
+    candidates = [x for x in before if x.label != args[i].label
+                  and types[x.label] == types[args[i].label]]
+    if not candidates:
+        return None
+    args[i] = candidates[rng.choice(len(candidates))]
+    return rebuild(sop, args, types[sop.label])
+
+
+MUTATIONS = {
+    "function": mutate_function,
+    "predicate": mutate_predicate,
+    "rewire": rewire,
+}
+
+
+def mutate(
+    rng: np.random.Generator,
+    program: rasp.SOp,
+    max_tries: int = 10,
+    telemetry: Optional[SamplingTelemetry] = None,
+) -> rasp.SOp:
+    """Apply a random mutation to a random SOp of program and return the
+    mutant, annotated with its length. Raises a SamplingError if the
+    mutant fails perform_checks, or if no mutation applies after
+    max_tries draws. Attempts are recorded in the telemetry under
+    "mutate_<kind>"."""
+    telemetry = telemetry if telemetry is not None else SamplingTelemetry()
+    order = rasp_utils.topological_order(program)
+    types, values = infer_types(order)
+    targets = [sop for sop in order if rasp_utils.sop_args(sop)]
+    for _ in range(max_tries):
+        sop = targets[rng.choice(len(targets))]
+        kind = list(MUTATIONS)[rng.choice(len(MUTATIONS))]
+        new = MUTATIONS[kind](rng, sop, order, types, values)
+        if new is not None:
+            break
+    else:
+        raise SamplingError("No mutation applies.", reason="no mutation")
+
+    start = time()
+    mutant = replace(program, order, sop, new, types)
+    mutant = rasp.annotate(mutant, length=rasp_utils.count_sops(mutant))
+    try:
+        if rasp_utils.is_equal(mutant, program):
+            raise SamplingError("Mutant is the same as the original.",
+                                reason="duplicate")
+        perform_checks(mutant, sample.CHECK_INPUTS)
+    except SamplingError as e:
+        telemetry.record(f"mutate_{kind}", time() - start, reason=e.reason)
+        raise
+    telemetry.record(f"mutate_{kind}", time() - start)
+    return mutant
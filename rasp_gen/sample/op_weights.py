@@ -0,0 +1,119 @@
+# Adaptive sampling weights for the SOp classes in Sampler.try_to_add_sop.
+# Some classes fail much more often than others, depending on what's in
+# scope (e.g. a categorical aggregate needs a none-free selector and a
+# categorical SOp to aggregate). Proposing them less often in those states
+# saves wasted attempts, but on its own would skew the mix of op classes
+# in the dataset. To avoid that, the marginal distribution of accepted
+# op classes is recorded during a warm-up with the static weights and
+# then kept fixed by a per-class correction factor.
+
+
+from collections import Counter, defaultdict
+from typing import Hashable
+import numpy as np
+
+
+class AdaptiveOpWeights:
+    """Reweights op classes by their acceptance rate in the current scope
+    state (see Sampler.scope_composition), times a correction factor that
+    keeps the marginal distribution of accepted op classes at the one
+    observed during warm-up.
+
+    Share one instance across the Samplers of a batch (sample.sample
+    takes it as a sampler kwarg) so that the rates carry over between
+    programs.
+    """
+    def __init__(
+        self,
+        warmup: int = 2000,
+        update_every: int = 200,
+        max_step: float = 2.,
+        max_correction: float = 10.,
+    ):
+        """
+        Args:
+            warmup: nr of accepted SOps sampled with the static weights, to
+                estimate the target marginal of op classes.
+            update_every: nr of accepted SOps between updates of the
+                correction factors.
+            max_step: max factor by which a correction changes per update.
+            max_correction: corrections are clipped to
+                [1 / max_correction, max_correction].
+        """
+        self.warmup = warmup
+        self.update_every = update_every
+        self.max_step = max_step
+        self.max_correction = max_correction
+        self.attempts = defaultdict(int)  # (op class, state) -> count
+        self.accepted = defaultdict(int)
+        self.target = Counter()  # accepted op classes during warm-up
+        self.realized = Counter()  # since the last correction update
+        self.correction = defaultdict(lambda: 1.)
+
+    @property
+    def warming_up(self) -> bool:
+        return sum(self.target.values()) < self.warmup
+
+    def acceptance_rate(self, op_class: str, state: Hashable) -> float:
+        """Laplace-smoothed fraction of accepted attempts."""
+        key = (op_class, state)
+        return (self.accepted[key] + 1) / (self.attempts[key] + 2)
+
+    def reweight(
+        self,
+        op_classes: list[str],
+        weights: np.ndarray,
+        state: Hashable,
+    ) -> np.ndarray:
+        """Return the proposal weights for op_classes, given their
+        static weights and the scope state."""
+        if self.warming_up:
+            return weights
+        factors = [self.acceptance_rate(c, state) * self.correction[c]
+                   for c in op_classes]
+        return weights * np.array(factors)
+
+    def update(self, op_class: str, state: Hashable, accepted: bool):
+        """Record the outcome of an attempt."""
+        self.attempts[(op_class, state)] += 1
+        if not accepted:
+            return
+        self.accepted[(op_class, state)] += 1
+        if self.warming_up:
+            self.target[op_class] += 1
+            return
+
+        self.realized[op_class] += 1
+        if sum(self.realized.values()) >= self.update_every:
+            self._update_correction()
+
+    def _update_correction(self):
+        """Multiply the correction of every op class by the ratio of its
+        target to its realized frequency since the last update, so that
+        the marginal converges to the target. The realized frequencies
+        are smoothed towards the target (by update_every pseudo-counts),
+        so that rare op classes aren't pushed around by single samples."""
+        n_target = sum(self.target.values())
+        n_realized = sum(self.realized.values())
+        for c in self.target:
+            target = self.target[c] / n_target
+            realized = ((self.realized[c] + self.update_every * target) / 
+                        (n_realized + self.update_every))
+            step = float(np.clip(target / realized, 1 / self.max_step,
+                                 self.max_step))
+            self.correction[c] *= step
+
+        # only relative corrections matter; normalize before clipping
+        norm = sum(self.target[c] / n_target * self.correction[c]
+                   for c in self.target)
+        for c in self.target:
+            self.correction[c] = float(np.clip(self.correction[c] / norm,
+                1 / self.max_correction, self.max_correction))
+        self.realized.clear()
+
+    def marginals(self) -> dict[str, dict[str, float]]:
+        """Target marginal of op classes and the current corrections."""
+        n = max(sum(self.target.values()), 1)
+        return {c: {"target": self.target[c] / n,
+                    "correction": self.correction[c]}
+                for c in self.target}
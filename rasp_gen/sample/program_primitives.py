@@ -2,15 +2,22 @@
 # can be sampled from to create larger programs.
 # That is, instead of sampling just from the basic RASP operations,
 # we can sample from a richer set of primitives.
-# (Currently we don't support this, but it's a good idea to have)
+# The macros in MACROS are sampled by Sampler.add_macro (if the Sampler
+# has use_macros=True). They are validated in tests/test_sampling.py.
 
 
 import os
+from typing import Callable
+from dataclasses import dataclass
 from tracr.rasp import rasp
 from tracr.compiler import compiling
 import numpy as np
 from tracr.compiler.validating import validate
 
+from rasp_gen.sample.map_primitives import CAT_TO_BOOL, FunctionWithRepr
+from rasp_gen.sample.rasp_utils import annotate_type, SamplingError
+from rasp_gen.sample.value_sets import COMPILER_VOCAB
+
 def make_length():
     all_true_selector = rasp.Select(rasp.tokens, rasp.tokens, rasp.Comparison.TRUE)
     return rasp.SelectorWidth(all_true_selector).named("length")
@@ -22,8 +29,76 @@ def reverse_selector() -> rasp.Selector:
     return rasp.Select(rasp.indices, reversed_indices, rasp.Comparison.EQ)
 
 
+# SOps that don't depend on the argument of a macro are built once, so
+# every program shares them (same labels, so a Sampler evaluates them once).
+LENGTH = annotate_type(make_length(), "categorical")
+OPP_INDEX = annotate_type(rasp.Map(
+    FunctionWithRepr("lambda x: x - 1"),
+    annotate_type(rasp.SequenceMap(
+        FunctionWithRepr("lambda x, y: x - y"), LENGTH, rasp.indices),
+        "categorical"),
+    simplify=False,
+), "categorical")
+PREVS = rasp.Select(rasp.indices, rasp.indices, rasp.Comparison.LEQ)
+# the "x == n" primitives in the tokenizer vocab, by n
+IS_VALUE = {n: fn for fn in CAT_TO_BOOL for n in range(10)
+            if repr(fn) == f"lambda x: x == {n}"}
+
+
+@dataclass(frozen=True)
+class Macro:
+    """A primitive made of several SOps, applied to a single SOp in scope.
+    build(sop, values, rng) returns the output SOp, where values is the
+    value set of sop (None if unknown). All SOps in between are either
+    built on sop or shared constants like LENGTH."""
+    name: str
+    input_type: str
+    output_type: str
+    build: Callable[[rasp.SOp, set | None, np.random.Generator], rasp.SOp]
+
+
+def reverse(sop: rasp.SOp, values: set | None, rng) -> rasp.SOp:
+    select = rasp.Select(rasp.indices, OPP_INDEX, rasp.Comparison.EQ)
+    return annotate_type(rasp.Aggregate(select, sop, default=None), "categorical")
+
+
+def sort_unique(sop: rasp.SOp, values: set | None, rng) -> rasp.SOp:
+    """Sort sop. Positions with repeated values get None."""
+    smaller = rasp.Select(sop, sop, rasp.Comparison.LT)
+    target_pos = annotate_type(rasp.SelectorWidth(smaller), "categorical")
+    select = rasp.Select(target_pos, rasp.indices, rasp.Comparison.EQ)
+    return annotate_type(rasp.Aggregate(select, sop, default=None), "categorical")
+
+
+def pair_balance(sop: rasp.SOp, values: set | None, rng) -> rasp.SOp:
+    """Fraction of previous positions where sop is an open token minus
+    the fraction where it's a close token (both drawn from values that
+    have an "x == n" primitive, so that the program can be tokenized)."""
+    values = values if values is not None else COMPILER_VOCAB
+    tokens = sorted(n for n in IS_VALUE if n in values)
+    if len(tokens) < 2:
+        raise SamplingError(f"{sop.label} takes less than two values "
+                            "with an x == n primitive.", reason="constant")
+    open_token, close_token = [tokens[i] for i in
+                               rng.choice(len(tokens), size=2, replace=False)]
+    fracs = []
+    for token in (open_token, close_token):
+        bools = annotate_type(rasp.Map(IS_VALUE[token], sop, simplify=False),
+                              "bool")
+        fracs.append(annotate_type(
+            rasp.Aggregate(PREVS, bools, default=0), "float"))
+    return annotate_type(rasp.LinearSequenceMap(*fracs, 1, -1), "float")
+
+
+MACROS = [
+    Macro("reverse", "categorical", "categorical", reverse),
+    Macro("sort_unique", "categorical", "categorical", sort_unique),
+    Macro("pair_balance", "categorical", "float", pair_balance),
+]
+
+
 
 # sel = Select(sop1, sop2, predicate)
 # sop = Aggregate(sel, sop_agg)
 # rewrite:
-# sop = SelectAggregate(sop1, sop2, predicate, sop_agg)
\ No newline at end of file
+# sop = SelectAggregate(sop1, sop2, predicate, sop_agg)
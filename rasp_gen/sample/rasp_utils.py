@@ -1,3 +1,4 @@
+import hashlib
 import numpy as np
 from tracr.rasp import rasp
 from tracr.compiler import rasp_to_graph
@@ -6,15 +7,21 @@ import networkx as nx
 
 
 class EmptyScopeError(Exception):
-    pass
+    def __init__(self, *args, reason: str = "empty scope"):
+        super().__init__(*args)
+        self.reason = reason
 
 
 class SamplingError(Exception):
     """Raised when the sampler fails to sample a program
     satisfying the given constraints.
     This error is (usually) not indicative of a bug.
+    The reason is a short tag used to collect rejection statistics
+    (see telemetry.SamplingTelemetry).
     """
-    pass
+    def __init__(self, *args, reason: str = "other"):
+        super().__init__(*args)
+        self.reason = reason
 
 
 def annotate_type(sop: rasp.SOp, type: str):
@@ -43,18 +50,22 @@ def filter_by_type(sops: list[rasp.SOp], type: str = None):
     return np.array(mask)
 
 
-def filter_nones(sops: list[rasp.SOp], test_inputs: list[list]):
-    mask = [1 if no_none_in_values(sop, test_inputs) else 0 for sop in sops]
+def filter_nones(sops: list[rasp.SOp], test_inputs: list[list],
+                 evaluate=rasp.evaluate):
+    mask = [1 if no_none_in_values(sop, test_inputs, evaluate) else 0
+            for sop in sops]
     if len(mask) == 0:
         raise EmptyScopeError("Filter failed. All SOps contain None on some test input.")
     return np.array(mask)
 
 
-def no_none_in_values(sop: rasp.SOp, test_inputs: list[list]):
-    """Return True if the SOp never contains None on any of the test inputs."""
+def no_none_in_values(sop: rasp.SOp, test_inputs: list[list],
+                      evaluate=rasp.evaluate):
+    """Return True if the SOp never contains None on any of the test inputs.
+    Pass the evaluate method of a MemoizedEvaluator to reuse cached outputs."""
     values = set()
     for x in test_inputs:
-        values = values.union(sop(x))
+        values = values.union(evaluate(sop, x))
     return not None in values
 
 
@@ -134,52 +145,122 @@ def count_sops(program: rasp.SOp):
     return sum(sops)
 
 
+def sop_args(sop: rasp.SOp) -> list[rasp.SOp]:
+    """Return the SOps that sop takes as input. Selects are looked 
+    through, e.g. Aggregate(Select(keys, queries), x) -> [keys, queries, x].
+    """
+    args = []
+    for child in sop.children:
+        if isinstance(child, rasp.Select):
+            args.extend(child.children)
+        else:
+            args.append(child)
+    return args
+
+
+def topological_order(program: rasp.SOp) -> list[rasp.SOp]:
+    """Return the SOps in a program (no Selects), each one after all of 
+    its args. Unlike print_program, this doesn't build a networkx graph."""
+    order, visited = [], set()
+    stack = [(program, False)]
+    while stack:
+        sop, expanded = stack.pop()
+        if expanded:
+            order.append(sop)
+        elif sop.label not in visited:
+            visited.add(sop.label)
+            stack.append((sop, True))
+            stack.extend((arg, False) for arg in reversed(sop_args(sop)))
+    return order
+
+
+# Memo of structural hashes, keyed by id(expr). Entries keep a reference
+# to expr, so that ids aren't reused while they're in the memo.
+_hash_memo: dict[int, tuple[rasp.RASPExpr, bytes]] = {}
+MAX_HASH_MEMO_SIZE = 2**14
+
+
+def structural_hash(expr: rasp.RASPExpr) -> bytes:
+    """Merkle-style hash of a RASP expression, built from its op type,
+    encoding, function / predicate / weights / default, and the hashes of
+    its children. Two expressions have the same hash iff they are built
+    the same way (up to labels and type annotations).
+    Hashes are memoized, so hashing a new SOp whose children were hashed
+    before is O(1), and DAGs with shared subexpressions are hashed in
+    linear time."""
+    entry = _hash_memo.get(id(expr))
+    if entry is not None and entry[0] is expr:
+        return entry[1]
+
+    digest = _combine_hashes(type(expr).__name__, _fields(expr),
+                             [structural_hash(child) for child in expr.children])
+    if len(_hash_memo) >= MAX_HASH_MEMO_SIZE:
+        _hash_memo.clear()
+    _hash_memo[id(expr)] = (expr, digest)
+    return digest
+
+
+def sequence_map_hash(fn, fst: rasp.SOp, snd: rasp.SOp) -> bytes:
+    """structural_hash of rasp.SequenceMap(fn, fst, snd) (categorical),
+    without building the SequenceMap."""
+    fields = (repr(fn), rasp.Encoding.CATEGORICAL.value)
+    return _combine_hashes("SequenceMap", fields,
+                           [structural_hash(fst), structural_hash(snd)])
+
+
+def _combine_hashes(name: str, fields: tuple, children: list[bytes]) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((name, fields)).encode())
+    for child in children:
+        h.update(child)
+    return h.digest()
+
+
+def _fields(expr: rasp.RASPExpr) -> tuple:
+    """Everything that defines expr apart from its children."""
+    if isinstance(expr, (rasp.TokensType, rasp.IndicesType)):
+        fields = ()
+    elif isinstance(expr, rasp.Map):
+        fields = (repr(expr.f),)
+    elif isinstance(expr, rasp.LinearSequenceMap):
+        fields = (expr.fst_fac, expr.snd_fac)
+    elif isinstance(expr, rasp.SequenceMap):
+        fields = (repr(expr.f),)
+    elif isinstance(expr, rasp.Select):
+        fields = (expr.predicate.name,)
+    elif isinstance(expr, rasp.Aggregate):
+        fields = (expr.default,)
+    elif isinstance(expr, rasp.SelectorWidth):
+        fields = ()
+    else:
+        raise ValueError(f"Unknown SOp type {type(expr)}.")
+    if isinstance(expr, rasp.SOp):
+        fields += (rasp.get_encoding(expr).value,)
+    return fields
+
+
 def is_equal(sop1: rasp.SOp, sop2: rasp.SOp, recursive=True,
              verbose=False):
     """Two rasp expressions are equal if
     1) they are the same op (eg both Maps)
     2) they have the same encoding
     3) they have the same args
+    If recursive, args are compared by structure (via structural_hash),
+    otherwise they must be the same objects.
     """
     if type(sop1) != type(sop2):
         return False
     elif sop1 is sop2:
         return True
-    
-    if isinstance(sop1, (rasp.TokensType, rasp.IndicesType)):
-        return True
 
-    def eq(x, y):
-        if recursive:
-            return is_equal(x, y, recursive=True, verbose=verbose)
-        else:
-            return x is y
-    
-    if isinstance(sop1, rasp.Map):
-        out = (sop1.f == sop2.f and
-               eq(sop1.inner, sop2.inner))
-    elif isinstance(sop1, rasp.LinearSequenceMap):
-        out = (sop1.fst_fac == sop2.fst_fac and
-               sop1.snd_fac == sop2.snd_fac and
-               eq(sop1.fst, sop2.fst) and
-               eq(sop1.snd, sop2.snd))
-    elif isinstance(sop1, rasp.SequenceMap):
-        out = (sop1.f == sop2.f and
-               eq(sop1.fst, sop2.fst) and
-               eq(sop1.snd, sop2.snd))
-    elif isinstance(sop1, rasp.Select):
-        out = (eq(sop1.keys, sop2.keys) and
-               eq(sop1.queries, sop2.queries) and
-               sop1.predicate == sop2.predicate)
-    elif isinstance(sop1, rasp.Aggregate):
-        out = (eq(sop1.selector, sop2.selector) and 
-               eq(sop1.sop, sop2.sop))
-    elif isinstance(sop1, rasp.SelectorWidth):
-        out = eq(sop1.selector, sop2.selector)
+    if recursive:
+        out = structural_hash(sop1) == structural_hash(sop2)
     else:
-        raise ValueError(f"Unknown SOp type {type(sop1)}.")
-    
+        children1, children2 = sop1.children, sop2.children
+        out = (all(x is y for x, y in zip(children1, children2)) and
+               _fields(sop1) == _fields(sop2))
+
     if verbose and not out:
         print(f"{sop1.label} != {sop2.label}")
-    
-    return out
\ No newline at end of file
+
+    return out
@@ -15,16 +15,23 @@
 # - it uses comparisons when appropriate (eg don't < compare two strings)
 
 
+import json
 from time import time
-from typing import Optional
+from collections import defaultdict
+from typing import Iterable, Optional
 from dataclasses import dataclass
+from pathlib import Path
 import numpy as np
 from tracr.rasp import rasp
-from tracr.compiler import validating
 from rasp_gen.sample import map_primitives
+from rasp_gen.sample import program_primitives
 from rasp_gen.sample import rasp_utils
+from rasp_gen.sample import value_sets
+from rasp_gen.sample.evaluate import BatchedEvaluator, MemoizedEvaluator
+from rasp_gen.sample.op_weights import AdaptiveOpWeights
 from rasp_gen.sample.rasp_utils import SamplingError
-from rasp_gen.sample.validate import perform_checks
+from rasp_gen.sample.telemetry import SamplingTelemetry
+from rasp_gen.sample.validate import dynamic_validate, perform_checks
 from rasp_gen.dataset.logger_config import setup_logger
 
 logger = setup_logger(__name__)
@@ -43,6 +50,59 @@ EXTRA_TEST_INPUTS += [
     for _ in range(50)]
 EXTRA_TEST_INPUTS = set([tuple(x) for x in EXTRA_TEST_INPUTS])
 
+# Inputs for perform_checks: the ones chosen by
+# scripts/select_check_inputs.py to make the same decisions as all
+# inputs, if that script has been run, else the random inputs above.
+CHECK_INPUTS_PATH = Path(__file__).parent / "check_inputs.json"
+CHECK_INPUTS = EXTRA_TEST_INPUTS
+if CHECK_INPUTS_PATH.exists():
+    with open(CHECK_INPUTS_PATH) as f:
+        CHECK_INPUTS = set([tuple(x) for x in json.load(f)["inputs"]])
+
+
+# Static (unnormalized) sampling weights of the SOp classes.
+OP_WEIGHTS = {
+    "map": 1,
+    "sequence_map": 0.8,
+    "linear_sequence_map": 1,
+    "numerical_aggregate": 1,
+    "categorical_aggregate": 1,
+    "selector_width": 0.05,
+    "macro": 0.3,  # only if use_macros
+}
+
+
+# Don't infer value sets that take more evaluations than this, e.g. 
+# for chains of LinearSequenceMaps. SOps with unknown value sets (None) 
+# aren't filtered.
+MAX_VALUE_SET_SIZE = 2**12
+
+
+# In goal-directed mode, SOps that aren't an argument of any other SOp 
+# yet (the frontier) are this many times more likely to be chosen as 
+# arguments, so that few SOps are left unused. (Weighting arguments by 
+# their program length instead tends to combine x with functions of x,
+# which gives more constant programs.)
+FRONTIER_BIAS = 10.
+
+
+@dataclass
+class SelectorInfo:
+    """A Select in the selector cache of a Sampler, with the nr of keys
+    it selects for every query on each of the test inputs."""
+    select: rasp.Select
+    widths: list[np.ndarray]
+
+    @property
+    def max_width(self) -> int:
+        return max(w.max() for w in self.widths)
+
+    @property
+    def max_frac_empty(self) -> float:
+        """Max over test inputs of the fraction of queries that select
+        nothing (these are None in a categorical Aggregate)."""
+        return max((w == 0).mean() for w in self.widths)
+
 
 def get_recency_bias_weights(n: int, alpha: float = 0.3) -> np.ndarray:
     """Unnormalized."""
@@ -54,21 +114,70 @@ class Sampler:
     """Sampler for RASP programs. 
     - Sampled SOps are added to self.scope.
     - self.past is a list of sets that keeps track of the indices of the SOps
-        that make up the past of each sampled SOp.
+        that make up the past of each sampled SOp (including itself), so
+        len(self.past[i]) is the program length of self.scope[i].
+    - self.evaluator caches the outputs of every SOp in scope on the test
+        inputs, so each new SOp is evaluated once from its children's outputs.
+    - self.candidates maps (type, none_free) to the indices of the SOps in
+        scope of that type (any type if None) that, if none_free, never
+        contain None on the test inputs. It is updated in add_to_scope
+        and pop_from_scope, together with the sampling weights.
+    - self.telemetry records attempts, rejections, and timings per SOp class.
+    - self.value_sets holds the value set of every SOp in scope, inferred
+        as in tracr's basis_inference but with every possible mean for
+        numerical Aggregates (None if too large to infer), so they contain
+        all values the SOps take. Functions and predicates that would be
+        constant on them are filtered out before building a SOp.
+    - self.op_weights, if given, adapts the weights of the SOp classes to
+        their acceptance rates (see op_weights.AdaptiveOpWeights).
+    - self.index_by_hash maps the structural hash of every SOp in scope to
+        its index, so that duplicates are rejected before being evaluated.
+    - self.selectors[i] caches the Selects sampled on SOps whose newest
+        one is self.scope[i], keyed by (keys label, queries label,
+        comparison), as SelectorInfos. Selects are reused, so their
+        matrices are evaluated once, and categorical Aggregates can prefer
+        selectors of width <= 1, which are valid by construction.
+    - self.n_uses counts how many SOps in scope take each SOp as argument.
+    - self.failed[i] holds the structural hashes of SOps that were rejected
+        after being built (e.g. too many Nones, overshoot, invalid output
+        domain) and whose newest argument is self.scope[i]. Their outcome
+        only depends on their arguments, so they are rejected before being
+        evaluated again, until self.scope[i] is popped.
+    - If use_macros, the sampler also proposes macros (multi-SOp
+        primitives from program_primitives.MACROS) as a single step.
+    - If target_length is given (goal-directed mode), arguments are chosen
+        among the SOps whose programs are shorter than target_length, 
+        preferring the frontier (n_uses == 0), and SOps that overshoot it
+        are rejected. This way most sampled SOps end up in the program.
     """
     def __init__(
         self, 
         rng: np.random.Generator,
         only_categorical: bool = False,
+        telemetry: Optional[SamplingTelemetry] = None,
+        op_weights: Optional[AdaptiveOpWeights] = None,
+        target_length: Optional[int] = None,
+        use_macros: bool = False,
     ):
         self.rng = rng
-        self.scope = [
-            rasp_utils.annotate_type(rasp.tokens, "categorical"),
-            rasp_utils.annotate_type(rasp.indices, "categorical"),
-        ]
-        self.past = [{0}, {1}]
+        self.scope = []
+        self.past = []
+        self.n_uses: list[int] = []
+        self.failed: list[set[bytes]] = []
+        self.selectors: list[dict[tuple, SelectorInfo]] = []
+        self.value_sets: list[set] = []
+        self.index_by_label: dict[str, int] = {}
+        self.index_by_hash: dict[bytes, int] = {}
+        self.candidates: dict[tuple, list[int]] = defaultdict(list)
+        self.weights: dict[tuple, list[float]] = defaultdict(list)
         self.only_categorical = only_categorical
-#        self.value_set = []  # dynamically infer value set TODO
+        self.evaluator = MemoizedEvaluator()
+        self.telemetry = telemetry if telemetry is not None else SamplingTelemetry()
+        self.op_weights = op_weights
+        self.target_length = target_length
+        self.use_macros = use_macros
+        self.add_to_scope(rasp_utils.annotate_type(rasp.tokens, "categorical"))
+        self.add_to_scope(rasp_utils.annotate_type(rasp.indices, "categorical"))
     
     def sample_from_scope(
         self,
@@ -77,38 +186,37 @@ class Sampler:
         size=None,
         replace=False,
         prefer_recent=False,
-    ) -> int | list[int]:
+    ) -> rasp.SOp | list[rasp.SOp]:
         """Sample a SOp that satisfies constraints.
-        Returns a index (or list of indices) of the sampled SOps in the scope.
+        Returns the sampled SOp (or list of SOps) from the scope.
         """
-        mask = rasp_utils.filter_by_type(self.scope, type=type)
-        if not allow_none_values:
-            mask *= rasp_utils.filter_nones(self.scope, TEST_INPUTS)
-            
-        if (size is not None and mask.sum() < size) or (mask.sum() < 1):
+        key = (type, not allow_none_values)
+        candidates = self.candidates[key]
+        if len(candidates) < (size or 1):
             raise rasp_utils.EmptyScopeError(
                 f"Filter failed. Not enough SOps in scope; "
-                "found {mask.sum()}, need {size}")
-
-        if prefer_recent:
-            weights = get_recency_bias_weights(len(self.scope), 0.5)
-        else:
-            weights = [1] * len(self.scope)
-        
-        weights[0] = 3
-
-        weights = np.array(weights)
-        weights = weights * mask
-        weights = weights / weights.sum()
-
-        assert len(self.scope) == len(weights)
-        assert len(mask) == len(weights)
+                f"found {len(candidates)}, need {size}")
+
+        weights = np.array(self.weights[key + (prefer_recent,)], dtype=float)
+        if self.target_length is not None:
+            lengths = np.array([len(self.past[i]) for i in candidates])
+            frontier = np.array([self.n_uses[i] == 0 for i in candidates])
+            weights *= np.where(lengths < self.target_length, 1., 0.)
+            weights *= np.where(frontier, FRONTIER_BIAS, 1.)
+            n_left = np.count_nonzero(weights)
+            if n_left < (1 if replace else size or 1):
+                raise rasp_utils.EmptyScopeError(
+                    f"Not enough SOps in scope shorter than the target "
+                    f"length; found {n_left}, need {size}")
+            if size == 2:
+                return self._sample_pair_within_target(
+                    candidates, weights, replace)
 
         idx = self.rng.choice(
-            len(mask),
+            candidates,
             size=size, 
             replace=replace, 
-            p=weights,
+            p=weights / weights.sum(),
         )
 
         if size is None:
@@ -116,6 +224,27 @@ class Sampler:
         else:
             return [self.scope[i] for i in idx]
 
+    def _sample_pair_within_target(
+        self,
+        candidates: list[int],
+        weights: np.ndarray,
+        replace: bool,
+    ) -> list[rasp.SOp]:
+        """Sample two SOps whose programs together are shorter than the
+        target length, so that an op on both doesn't overshoot it."""
+        first = self.rng.choice(len(candidates), p=weights / weights.sum())
+        past = self.past[candidates[first]]
+        union_lengths = np.array(
+            [len(past | self.past[i]) for i in candidates])
+        weights = np.where(union_lengths < self.target_length, weights, 0.)
+        if not replace:
+            weights[first] = 0.
+        if not weights.any():
+            raise rasp_utils.EmptyScopeError(
+                "No pair of SOps in scope is shorter than the target length.")
+        second = self.rng.choice(len(candidates), p=weights / weights.sum())
+        return [self.scope[candidates[first]], self.scope[candidates[second]]]
+
     def add_map(self):
         """Sample a map. A map applies a function elementwise to a SOp.
         The input SOps can be categorical, float, or bool."""
@@ -126,9 +255,12 @@ class Sampler:
         output_types = (["categorical"] if self.only_categorical 
                         else map_primitives.TYPES)
         fn, output_type = map_primitives.get_map_fn(
-            self.rng, input_type, output_types)
+            self.rng, input_type, output_types, domain=self.value_set(sop_in))
+        if fn is None:
+            raise SamplingError(f"No non-constant map on {sop_in.label}.",
+                                reason="constant")
         sop_out = rasp.Map(fn, sop_in, simplify=False)
-        self.scope.append(rasp_utils.annotate_type(sop_out, type=output_type))
+        self.add_to_scope(rasp_utils.annotate_type(sop_out, type=output_type))
 
     def add_sequence_map(self):
         """Sample a sequence map. A SM applies a function elementwise to
@@ -138,9 +270,18 @@ class Sampler:
             size=2, 
             replace=False,
         )
-        fn = self.rng.choice(map_primitives.NONLINEAR_SEQMAP_FNS)
+        domains = [self.value_set(sop) for sop in sops_in]
+        fns = [fn for fn in map_primitives.NONLINEAR_SEQMAP_FNS
+               if (None in domains or not map_primitives.is_constant(fn, *domains))
+               and not self.is_known_failure_hash(
+                   rasp_utils.sequence_map_hash(fn, *sops_in), sops_in)]
+        if not fns:
+            raise SamplingError("No non-constant sequence map on "
+                                f"{[sop.label for sop in sops_in]}.",
+                                reason="constant")
+        fn = self.rng.choice(fns)
         sop_out = rasp.SequenceMap(fn, *sops_in)
-        self.scope.append(rasp_utils.annotate_type(sop_out, type="categorical"))
+        self.add_to_scope(rasp_utils.annotate_type(sop_out, type="categorical"))
 
     def add_linear_sequence_map(self):
         """Sample a linear sequence map. A LNS linearly combines two
@@ -154,7 +295,7 @@ class Sampler:
             map_primitives.LINEAR_SEQUENCE_MAP_WEIGHTS, size=2, replace=True)
         weights = [int(w) for w in weights]
         sop_out = rasp.LinearSequenceMap(*sops_in, *weights)
-        self.scope.append(rasp_utils.annotate_type(sop_out, type="float"))
+        self.add_to_scope(rasp_utils.annotate_type(sop_out, type="float"))
 
     def add_numerical_aggregate(self):
         """
@@ -164,14 +305,14 @@ class Sampler:
         aggregates with numerical SOps.
         Note: outputs are always in the closed interval [0, 1] ('frequencies').
         """
-        selector = self.get_selector()
+        selector = self._get_selector_or_raise()
         sop_in = self.sample_from_scope(
             type="bool",
             allow_none_values=False,
         )
         sop_out = rasp.Aggregate(selector, sop_in, default=0)
         # TODO: sometimes output can be bool here?
-        self.scope.append(rasp_utils.annotate_type(sop_out, type="float"))
+        self.add_to_scope(rasp_utils.annotate_type(sop_out, type="float"))
 
     def add_categorical_aggregate(self, max_retries=10):
         """
@@ -179,47 +320,105 @@ class Sampler:
         operations must satisfy the constraint that there is no aggregation (eg averaging).
         This usually means that the selector has width 1, but it could also mean that a width > 1
         selector is used but the output domain of the aggregate is still equal to the input domain.
+        Selectors that select everything (width > 1) are never sampled. Selectors
+        of width <= 1 that leave at most half of the queries empty are preferred,
+        since they are valid by construction; the rest are checked on the test
+        inputs, together with the fraction of Nones in the output.
         """
-        sop_in = self.sample_from_scope(
-            type="categorical",
-            allow_none_values=False,
-        )
-        selector = self.get_selector()
-        sop_out = rasp.Aggregate(selector, sop_in, default=None)
-        sop_out = rasp_utils.annotate_type(sop_out, type="categorical")
-
-        # validate:
-        if not all(
-            set(sop_out(x)).issubset(set(sop_in(x)) | {None}) for x in TEST_INPUTS
-        ):
-            if max_retries > 0:
-                self.add_categorical_aggregate(max_retries=max_retries-1)
-            else:
-                raise SamplingError(
-                    "Could not sample categorical Aggregate with valid output domain "
-                    "(Maximum retries reached). "
-                    "This because the sampler couldn't find a selector with width 1, and other sampled selectors "
-                    "don't result in an output domain that is a subset of the input domain."
-                )
+        for _ in range(max_retries + 1):
+            sop_in = self.sample_from_scope(
+                type="categorical",
+                allow_none_values=False,
+            )
+            selector = self.get_selector(allow_select_all=False,
+                                         prefer_width_one=True)
+            if selector is None:
+                continue
+            sop_out = rasp.Aggregate(selector, sop_in, default=None)
+            sop_out = rasp_utils.annotate_type(sop_out, type="categorical")
+            if self.is_duplicate(sop_out) or self.is_known_failure(sop_out):
+                continue
+
+            width_one = self.is_width_one(selector)
+            if width_one:
+                break
+
+            # validate:
+            if all(
+                set(self.evaluate(sop_out, x)).issubset(
+                    set(self.evaluate(sop_in, x)) | {None})
+                and rasp_utils.fraction_none(self.evaluate(sop_out, x)) <= 0.5
+                for x in TEST_INPUTS
+            ):
+                break
+            self.record_failure(sop_out)
         else:
-            for x in TEST_INPUTS:
-                errs = validating.validate(sop_out, x)
-                if len(errs) > 0:
-                    print()
-                    logger.warning(f"Sampled categorical Aggregate failed validation: {errs}")
-                    logger.info(f"test input: {x}")
-                    logger.info(f"aggregate sop: {sop_out.label}")
-                    print()
-            self.scope.append(sop_out)
+            raise SamplingError(
+                "Could not sample categorical Aggregate with valid output domain "
+                "(Maximum retries reached). "
+                "This because the sampler couldn't find a selector with width 1, and other sampled selectors "
+                "don't result in an output domain that is a subset of the input domain.",
+                reason="aggregate output domain",
+            )
+
+        if not width_one:  # width-one selectors are valid by construction
+            inputs = list(TEST_INPUTS)
+            invalid = dynamic_validate(
+                sop_out, BatchedEvaluator.from_inputs(inputs))
+            if invalid.any():
+                logger.warning("Sampled categorical Aggregate failed validation.")
+                logger.info(f"test inputs: {[x for x, i in zip(inputs, invalid) if i]}")
+                logger.info(f"aggregate sop: {sop_out.label}")
+        self.add_to_scope(sop_out)
 
     def add_selector_width(self):
-        selector = self.get_selector()
+        selector = self._get_selector_or_raise()
         sop_out = rasp.SelectorWidth(selector)
-        self.scope.append(rasp_utils.annotate_type(sop_out, type="categorical"))
+        self.add_to_scope(rasp_utils.annotate_type(sop_out, type="categorical"))
+
+    def add_macro(self):
+        """Sample a macro and add its SOps that aren't in scope yet, each
+        after its arguments, so that the macro's output is the newest SOp.
+        The macro is rejected if any of them is a duplicate of a different
+        SOp in scope."""
+        macros = [m for m in program_primitives.MACROS
+                  if not self.only_categorical or m.output_type == "categorical"]
+        macro = macros[self.rng.choice(len(macros))]
+        sop_in = self.sample_from_scope(
+            type=macro.input_type,
+            allow_none_values=False,
+        )
+        sop_out = macro.build(sop_in, self.value_set(sop_in), self.rng)
+        new_sops = [sop for sop in rasp_utils.topological_order(sop_out)
+                    if sop.label not in self.index_by_label]
+        for n_added, sop in enumerate(new_sops):
+            try:
+                self.add_to_scope(sop)
+            except (SamplingError, ValueError):
+                for _ in range(n_added):
+                    self.pop_from_scope()
+                raise
+
+    def _get_selector_or_raise(self) -> rasp.Select:
+        selector = self.get_selector()
+        if selector is None:
+            raise SamplingError("No predicate selects anything.",
+                                reason="constant")
+        return selector
 
-    def get_selector(self):
+    def get_selector(
+        self,
+        allow_select_all: bool = True,
+        prefer_width_one: bool = False,
+    ) -> rasp.Select | None:
         """Sample a rasp.Select. A select takes two categorical SOps and
         returns a selector (matrix) of booleans. Note this is not an SOp.
+        Predicates that are false for all pairs of values of the keys and
+        queries (and, unless allow_select_all, those that are true for all
+        pairs) are not sampled. Returns None if no predicate is left.
+        If prefer_width_one, predicates that give width-one selectors (see
+        is_width_one) are sampled if there are any.
+        Selects come from the selector cache (see cached_selector).
         """
         # TODO: allow Selectors with bools (numerical & 0-1) as input?
         sops_in = self.sample_from_scope(
@@ -228,9 +427,60 @@ class Sampler:
             size=2,
             replace=True,
         )
-        comparison = self.rng.choice(map_primitives.COMPARISONS)
-        selector = rasp.Select(*sops_in, comparison)
-        return selector
+        keys, queries = sops_in
+        key_values, query_values = self.value_set(keys), self.value_set(queries)
+        if key_values is None or query_values is None:
+            comparisons = map_primitives.COMPARISONS
+        else:
+            comparisons = []
+            for comparison in map_primitives.COMPARISONS:
+                selected = value_sets.predicate_values(
+                    comparison, key_values, query_values)
+                if True in selected and (allow_select_all or False in selected):
+                    comparisons.append(comparison)
+        if not comparisons:
+            return None
+        if prefer_width_one:
+            width_one = [c for c in comparisons if self.is_width_one(
+                self.cached_selector(keys, queries, c))]
+            comparisons = width_one or comparisons
+        comparison = self.rng.choice(comparisons)
+        return self.cached_selector(keys, queries, comparison)
+
+    def cached_selector(
+        self,
+        keys: rasp.SOp,
+        queries: rasp.SOp,
+        comparison: rasp.Comparison,
+    ) -> rasp.Select:
+        """Return the Select on keys and queries (both in scope) with
+        the given comparison, building and evaluating it on the test
+        inputs only the first time."""
+        newest = max(self.index_by_label[keys.label],
+                     self.index_by_label[queries.label])
+        key = (keys.label, queries.label, comparison)
+        if key not in self.selectors[newest]:
+            select = rasp.Select(keys, queries, comparison)
+            widths = [np.array(self.evaluate(select, x)).sum(axis=1)
+                      for x in TEST_INPUTS]
+            self.selectors[newest][key] = SelectorInfo(select, widths)
+        return self.selectors[newest][key].select
+
+    def selector_info(self, select: rasp.Select) -> SelectorInfo:
+        """SelectorInfo of a Select returned by cached_selector."""
+        keys, queries = select.keys, select.queries
+        newest = max(self.index_by_label[keys.label],
+                     self.index_by_label[queries.label])
+        return self.selectors[newest][(keys.label, queries.label,
+                                       select.predicate)]
+
+    def is_width_one(self, select: rasp.Select) -> bool:
+        """True if the Select never selects more than one key, and leaves
+        at most half of the queries empty, on every test input. A 
+        categorical Aggregate of a none-free SOp with it is then valid:
+        its values are a subset of the SOp's, with at most half None."""
+        info = self.selector_info(select)
+        return info.max_width <= 1 and info.max_frac_empty <= 0.5
 
     def try_to_add_sop(self, avoid_types: set[str]) -> tuple[list, set[str]]:
         """Sample a single SOp.
@@ -244,76 +494,316 @@ class Sampler:
             "numerical_aggregate": self.add_numerical_aggregate,
             "categorical_aggregate": self.add_categorical_aggregate,
             "selector_width": self.add_selector_width,
+            "macro": self.add_macro,
         }
 
-        weights = {
-            "map": 1,
-            "sequence_map": 0.8,
-            "linear_sequence_map": 1,
-            "numerical_aggregate": 1,
-            "categorical_aggregate": 1,
-            "selector_width": 0.05,
-        }
+        weights = dict(OP_WEIGHTS)
         if self.only_categorical:
             weights["linear_sequence_map"] = 0
             weights["numerical_aggregate"] = 0
-
-        sop_classes = list(set(add_functions.keys()) - set(avoid_types))
-        weights = np.array([weights[c] for c in sop_classes]); weights /= weights.sum()
+        if not self.use_macros:
+            weights["macro"] = 0
+
+        # iterate in dict order so that sampling is reproducible across 
+        # processes (set order of strings depends on PYTHONHASHSEED)
+        sop_classes = [c for c in add_functions if c not in avoid_types]
+        weights = np.array([weights[c] for c in sop_classes], dtype=float)
+        if self.op_weights is not None:
+            state = self.scope_composition()
+            weights = self.op_weights.reweight(sop_classes, weights, state)
+        if weights.sum() == 0:
+            raise SamplingError("Failed to sample any SOp class.",
+                                reason="all classes failed")
+        weights /= weights.sum()
         sop_class = self.rng.choice(sop_classes, p=weights)
         add = add_functions[sop_class]
 
+        start = time()
+        n_before = len(self.scope)
         try:
             add()
+            if (self.target_length is not None and 
+                    self.current_length() > self.target_length):
+                self.reject_newest(n_before)
+                raise SamplingError("Sampled SOp overshoots the target length.",
+                                    reason="overshoot")
             if any(rasp_utils.fraction_none(self.run(x)) > 0.5 for x in TEST_INPUTS):
-                del self.scope[-1]
-                raise SamplingError(f"Sampled SOp has too many None values.")
+                self.reject_newest(n_before)
+                raise SamplingError(f"Sampled SOp has too many None values.",
+                                    reason="too many nones")
             logger.debug(f"Sampled: {sop_class}")
+            self.telemetry.record(sop_class, time() - start)
+            if self.op_weights is not None:
+                self.op_weights.update(sop_class, state, accepted=True)
             avoid_types.clear()
         except (rasp_utils.EmptyScopeError, SamplingError, ValueError) as e:
             if isinstance(e, ValueError) and not e.args[0] in ["key is None!", "query is None!"]:
                 raise # reraise other ValueErrors
 
             logger.debug(f"Failed to sample {sop_class}, retrying. {e}")
-            # TODO: maybe I should return the error type and message to
-            # collect stats on most common errors
+            reason = getattr(e, "reason", "nones in select")
+            self.telemetry.record(sop_class, time() - start, reason=reason)
+            if self.op_weights is not None:
+                self.op_weights.update(sop_class, state, accepted=False)
             avoid_types.add(sop_class)
         return avoid_types
     
+    def add_to_scope(self, sop: rasp.SOp):
+        """Append a (type-annotated) SOp to the scope and update the
+        candidate indices, sampling weights, and past.
+        Raises a SamplingError if the SOp is already in scope or was
+        rejected before (see self.failed)."""
+        sop_hash = rasp_utils.structural_hash(sop)
+        if sop_hash in self.index_by_hash:
+            duplicate = self.scope[self.index_by_hash[sop_hash]]
+            raise SamplingError(f"{sop.label} is the same as {duplicate.label}.",
+                                reason="duplicate")
+        idx = len(self.scope)
+        past = {idx}
+        args = [self.index_by_label[arg.label] for arg in rasp_utils.sop_args(sop)]
+        if args and sop_hash in self.failed[max(args)]:
+            raise SamplingError(f"{sop.label} was rejected before.",
+                                reason="known failure")
+        for arg in args:
+            past |= self.past[arg]
+        values = value_sets.value_set(sop, [self.value_sets[arg] for arg in args],
+                                      max_size=MAX_VALUE_SET_SIZE,
+                                      exact_means=True)
+
+        type = sop.annotations["type"]
+        keys = [(None, False), (type, False)]
+        try:
+            none_free = rasp_utils.no_none_in_values(sop, TEST_INPUTS, self.evaluate)
+        except ValueError:  # Nones in Select
+            self.failed[max(args)].add(sop_hash)
+            raise
+        if none_free:
+            keys += [(None, True), (type, True)]
+
+        uniform_weight = 3 if idx == 0 else 1
+        recency_weight = 3 if idx == 0 else get_recency_bias_weights(idx+1, 0.5)[-1]
+        for key in keys:
+            self.candidates[key].append(idx)
+            self.weights[key + (False,)].append(uniform_weight)
+            self.weights[key + (True,)].append(recency_weight)
+        self.scope.append(sop)
+        self.past.append(past)
+        self.value_sets.append(values)
+        self.n_uses.append(0)
+        self.failed.append(set())
+        self.selectors.append({})
+        for arg in set(args):
+            self.n_uses[arg] += 1
+        self.index_by_label[sop.label] = idx
+        self.index_by_hash[sop_hash] = idx
+
+    def pop_from_scope(self) -> rasp.SOp:
+        """Remove the most recently added SOp from the scope."""
+        idx = len(self.scope) - 1
+        for key, candidates in self.candidates.items():
+            if candidates and candidates[-1] == idx:
+                candidates.pop()
+                self.weights[key + (False,)].pop()
+                self.weights[key + (True,)].pop()
+        self.past.pop()
+        self.value_sets.pop()
+        self.n_uses.pop()
+        self.failed.pop()
+        self.selectors.pop()
+        for label in {arg.label for arg in rasp_utils.sop_args(self.scope[-1])}:
+            self.n_uses[self.index_by_label[label]] -= 1
+        del self.index_by_label[self.scope[-1].label]
+        del self.index_by_hash[rasp_utils.structural_hash(self.scope[-1])]
+        return self.scope.pop()
+
+    def reject_newest(self, n_before: int):
+        """Record the newest SOp as a failure and pop the scope back to
+        n_before SOps (more than one for macros)."""
+        self.record_failure(self.scope[-1])
+        while len(self.scope) > n_before:
+            self.pop_from_scope()
+
+    def is_duplicate(self, sop: rasp.SOp) -> bool:
+        """True if a structurally identical SOp is already in scope."""
+        return rasp_utils.structural_hash(sop) in self.index_by_hash
+
+    def is_known_failure(self, sop: rasp.SOp) -> bool:
+        """True if a structurally identical SOp was rejected before
+        (and its arguments haven't been popped since)."""
+        return self.is_known_failure_hash(rasp_utils.structural_hash(sop),
+                                          rasp_utils.sop_args(sop))
+
+    def is_known_failure_hash(
+        self,
+        sop_hash: bytes,
+        args: list[rasp.SOp],
+    ) -> bool:
+        """Like is_known_failure, for the SOp with structural hash sop_hash
+        built from args, without building it."""
+        newest_arg = max(self.index_by_label[arg.label] for arg in args)
+        return sop_hash in self.failed[newest_arg]
+
+    def record_failure(self, sop: rasp.SOp):
+        """Remember that a SOp built from SOps in scope was rejected."""
+        newest_arg = max(self.index_by_label[arg.label]
+                         for arg in rasp_utils.sop_args(sop))
+        self.failed[newest_arg].add(rasp_utils.structural_hash(sop))
+
+    def value_set(self, sop: rasp.SOp) -> set | None:
+        """Value set of a SOp in scope (None if unknown)."""
+        return self.value_sets[self.index_by_label[sop.label]]
+
+    def scope_composition(self, cap: int = 3) -> tuple[int, ...]:
+        """Nr of SOps in scope of each type, and of those the nr that
+        never contain None, each capped at cap."""
+        return tuple(min(len(self.candidates[(type, none_free)]), cap)
+                     for type in map_primitives.TYPES
+                     for none_free in (False, True))
+
+    def evaluate(self, sop: rasp.SOp, x):
+        """Evaluate a SOp on a single input, reusing cached outputs."""
+        return self.evaluator.evaluate(sop, x)
+
     def run(self, x):
         """Run the RASP program on a single input."""
-        return self.scope[-1](x)
+        return self.evaluate(self.scope[-1], x)
     
     def current_length(self):
-        return rasp_utils.count_sops(self.scope[-1])
+        """Number of SOps in the program ending in the newest SOp."""
+        return len(self.past[-1])
 
 
 def sample(
     rng: np.random.Generator,
     program_length: int,
+    max_retries: int = 5,
+    time_limit: float = 30,
+    telemetry: Optional[SamplingTelemetry] = None,
+    goal_directed: bool = False,
+    harvested: Optional[list] = None,
+    harvest_lengths: Optional[Iterable[int]] = None,
     **sampler_kwargs,
 ) -> rasp.SOp:
     """Sample a RASP program.
     Args:
         rng: numpy random number generator
         program_length: length of the program in SOps
+        max_retries: number of failures allowed at each scope depth before
+            backtracking one step further.
+        time_limit: seconds after which sampling restarts from scratch.
+        telemetry: if given, rejection counts and timings are recorded here.
+        goal_directed: if True, build towards program_length instead of
+            sampling SOps until one happens to have the right length 
+            (see Sampler, target_length).
+        harvested: if given, the intermediate SOps of the program's scope
+            whose lengths are in harvest_lengths (default: program_length)
+            and that pass perform_checks are appended to it (see harvest).
     """
+    telemetry = telemetry if telemetry is not None else SamplingTelemetry()
+    sampler_kwargs["telemetry"] = telemetry
+    if goal_directed:
+        sampler_kwargs["target_length"] = program_length
     start = time()
     sampler = Sampler(rng, **sampler_kwargs)
     avoid = set()
-    while sampler.current_length() != program_length:
-        avoid = sampler.try_to_add_sop(avoid)
-        if time() - start > 30:
+    retries = defaultdict(int)  # nr of failures at each scope depth
+    while True:
+        if time() - start > time_limit:
             logger.info("Sampling took too long, resampling.")
-            return sample(rng, program_length=program_length, **sampler_kwargs)
-    program = sampler.scope[-1]
-    program = rasp.annotate(program, length=sampler.current_length())
-
-    try:
-        perform_checks(program, EXTRA_TEST_INPUTS)
-    except SamplingError as e:
-        logger.info(f"Failed checks, resampling. {e}")
-        return sample(rng, program_length=program_length, **sampler_kwargs)
-
-    logger.debug(f"(sample) Size of scope: {len(sampler.scope)}")
-    return program
+            telemetry.record("program", time() - start, reason="timeout")
+            start = time()
+            sampler = Sampler(rng, **sampler_kwargs)
+            avoid = set()
+            retries.clear()
+
+        if sampler.current_length() != program_length:
+            try:
+                avoid = sampler.try_to_add_sop(avoid)
+            except SamplingError as e:
+                logger.debug(f"Backtracking. {e}")
+                if not backtrack(sampler, retries, max_retries, program_length):
+                    sampler = Sampler(rng, **sampler_kwargs)
+                    retries.clear()
+                avoid = set()
+            continue
+
+        program = sampler.scope[-1]
+        program = rasp.annotate(program, length=sampler.current_length())
+        checks_start = time()
+        try:
+            perform_checks(program, CHECK_INPUTS)
+        except SamplingError as e:
+            logger.info(f"Failed checks, backtracking. {e}")
+            telemetry.record("program", time() - checks_start, reason=e.reason)
+            if not backtrack(sampler, retries, max_retries, program_length):
+                sampler = Sampler(rng, **sampler_kwargs)
+                retries.clear()
+            continue
+        telemetry.record("program", time() - checks_start)
+        if harvested is not None:
+            lengths = (harvest_lengths if harvest_lengths is not None
+                       else [program_length])
+            harvested.extend(harvest(sampler, lengths, telemetry))
+
+        logger.debug(f"(sample) Size of scope: {len(sampler.scope)}")
+        return program
+
+
+def harvest(
+    sampler: Sampler,
+    lengths: Iterable[int],
+    telemetry: Optional[SamplingTelemetry] = None,
+) -> list[rasp.SOp]:
+    """Return the SOps in scope (except the newest, which is the sampled
+    program) whose program lengths are in lengths and that pass
+    perform_checks, annotated with their lengths like sampled programs.
+    Note that this skews the distribution of programs towards the SOps
+    that sampling builds on, e.g. short Maps of tokens."""
+    telemetry = telemetry if telemetry is not None else SamplingTelemetry()
+    lengths = set(lengths)
+    programs = []
+    for sop, past in zip(sampler.scope[:-1], sampler.past[:-1]):
+        if len(past) not in lengths:
+            continue
+        program = rasp.annotate(sop, length=len(past))
+        start = time()
+        try:
+            perform_checks(program, CHECK_INPUTS)
+        except SamplingError as e:
+            telemetry.record("harvest", time() - start, reason=e.reason)
+            continue
+        telemetry.record("harvest", time() - start)
+        programs.append(program)
+    return programs
+
+
+def backtrack(
+    sampler: Sampler,
+    retries: dict[int, int],
+    max_retries: int,
+    program_length: int,
+) -> bool:
+    """Pop the newest SOp from the scope after a failure at its depth.
+    Once a depth has failed more than max_retries times, also pop the 
+    SOp before it (and so on), resetting the budget of the popped depth.
+    Finally pop SOps that are already too long to be part of the program,
+    since new SOps are biased towards building on the most recent ones.
+    Returns False (and pops nothing) if only the inputs are left, in which
+    case the caller should start over with a new Sampler.
+    """
+    n_inputs = 2  # tokens and indices are never popped
+    depth = len(sampler.scope)
+    if depth == n_inputs:
+        return False
+    retries[depth] += 1
+    sampler.pop_from_scope()
+    while retries[depth] > max_retries and len(sampler.scope) > n_inputs:
+        retries[depth] = 0
+        depth -= 1
+        retries[depth] += 1
+        sampler.pop_from_scope()
+    while (len(sampler.scope) > n_inputs and 
+           sampler.current_length() >= program_length):
+        retries[len(sampler.scope)] = 0
+        sampler.pop_from_scope()
+    return True
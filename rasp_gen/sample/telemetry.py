@@ -0,0 +1,64 @@
+from collections import Counter, defaultdict
+from pathlib import Path
+import json
+from typing import Optional
+
+
+class SamplingTelemetry:
+    """Counts attempts and rejections of the sampler, per op class and
+    rejection reason, together with the wall time spent on each op class.
+
+    Op classes are the SOp classes of Sampler.try_to_add_sop, plus
+    "program" for the checks on finished programs, "harvest" for the
+    checks on their intermediate SOps (see sample.harvest), "mutate_<kind>"
+    for mutants (see mutate.py), "enumerate" for enumerated programs (see
+    enumeration.py), "accept" for the final decision to save a datapoint
+    (duplicates and stratum quotas, see generate._accept), and "filter" for
+    programs rejected after sampling (e.g. in generate.py). Reasons are
+    the .reason tags of SamplingError and EmptyScopeError.
+    """
+    def __init__(self):
+        self.attempts = Counter()
+        self.seconds = defaultdict(float)
+        self.rejections = defaultdict(Counter)
+
+    def record(
+        self,
+        op_class: str,
+        seconds: float = 0.,
+        reason: Optional[str] = None,
+    ):
+        """Record an attempt. A reason of None means it was accepted."""
+        self.attempts[op_class] += 1
+        self.seconds[op_class] += seconds
+        if reason is not None:
+            self.rejections[op_class][reason] += 1
+
+    def merge(self, other: "SamplingTelemetry") -> "SamplingTelemetry":
+        """Add the counts and timings of other to self."""
+        self.attempts.update(other.attempts)
+        for op_class, seconds in other.seconds.items():
+            self.seconds[op_class] += seconds
+        for op_class, reasons in other.rejections.items():
+            self.rejections[op_class].update(reasons)
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            op_class: {
+                "attempts": attempts,
+                "accepted": attempts - sum(self.rejections[op_class].values()),
+                "seconds": self.seconds[op_class],
+                "rejections": dict(self.rejections[op_class].most_common()),
+            }
+            for op_class, attempts in self.attempts.most_common()
+        }
+
+    def dump(self, path: Path | str):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def __repr__(self):
+        return f"SamplingTelemetry({self.to_dict()})"
@@ -3,6 +3,7 @@ import numpy as np
 
 from rasp_gen.sample import rasp_utils
 from rasp_gen.sample.rasp_utils import SamplingError
+from rasp_gen.sample.evaluate import BatchedEvaluator
 from rasp_gen.dataset.logger_config import setup_logger
 
 from tracr.rasp import rasp
@@ -59,45 +60,92 @@ def validate_compilation(expr: rasp.SOp, test_input: list) -> None:
 
 def perform_checks(program, inputs: list[list]):
     """Given a sampled program, perform checks to see if we need to resample.
+    The program is evaluated on all inputs at once with a BatchedEvaluator.
     """
     if len(validating.validate(program)) > 0:
-        raise SamplingError("Program failed static validation.")
-
-    try:
-        outputs = [program(x) for x in inputs]
-    except ValueError as e:
-        if e.args[0] in ["key is None!", "query is None!"]:
-            raise SamplingError(f"Program {program} is invalid "
-                                "due to Nones in Select.")
-        elif e.args[0].startswith("Only types int, bool, and float "
-                                  "are supported for aggregation."):
-            raise SamplingError(f"Program {program} is invalid "
-                                "due to Nones in Aggregate.")
-        else:
-            raise
+        raise SamplingError("Program failed static validation.",
+                            reason="static validation")
+
+    evaluator = BatchedEvaluator.from_inputs(inputs)
+    outputs = evaluator.evaluate(program)
+    if evaluator.none_in_select.any():
+        raise SamplingError(f"Program {program} is invalid "
+                            "due to Nones in Select.",
+                            reason="nones in select")
+    elif evaluator.none_in_aggregate.any():
+        raise SamplingError(f"Program {program} is invalid "
+                            "due to Nones in Aggregate.",
+                            reason="nones in aggregate")
+
+    mask = evaluator.mask
+    if np.array_equal(outputs[mask], evaluator.tokens[mask]):
+        raise SamplingError("Program is the identity.", reason="identity")
+
+    nones = (np.isnan(outputs) & mask).sum(axis=1)
+    if any(nones / evaluator.lengths > 0.5):
+        raise SamplingError("Program returns None too often.",
+                            reason="too many nones")
+
+    if is_constant(outputs, evaluator.lengths):
+        raise SamplingError("Program returns the same value too often.",
+                            reason="constant")
+    
+    if dynamic_validate(program, evaluator).any():
+        raise SamplingError("Program failed dynamic validation.",
+                            reason="dynamic validation")
 
-    if outputs == inputs:
-        raise SamplingError("Program is the identity.")
+    return None
 
-    if any(rasp_utils.fraction_none(x) > 0.5 for x in outputs):
-        raise SamplingError("Program returns None too often.")
 
-    if is_constant(outputs):
-        raise SamplingError("Program returns the same value too often.")
-    
-    tracr_dynamic_validate(program, inputs)
+def dynamic_validate(program: rasp.SOp, evaluator: BatchedEvaluator
+                     ) -> np.ndarray:
+    """Batched version of the dynamic part of tracr's validation, i.e.
+    of validating.DynamicValidationEvaluator on every input of the 
+    evaluator (validating.validate(program, x) additionally runs the
+    static checks). Returns an (N,) boolean array, True where tracr
+    would report an unsupported expression. Reuses the evaluator's cached outputs, so
+    the program is only evaluated once for all inputs.
 
-    return None
+    tracr checks every Aggregate in the program:
+    - a categorical Aggregate must not average, i.e. its outputs must be
+      values of its input SOp (or None)
+    - a numerical Aggregate can only average binary values, i.e. its
+      input SOp must only take values 0 and 1 (not None)
+
+    Inputs on which tracr raises (see evaluator.errors) are not covered.
+    """
+    mask = evaluator.mask
+    invalid = np.zeros(len(mask), dtype=bool)
+    for sop in rasp_utils.topological_order(program):
+        if not isinstance(sop, rasp.Aggregate):
+            continue
+        out = evaluator.evaluate(sop)
+        values = evaluator.evaluate(sop.sop)
+        if rasp.is_categorical(sop):
+            # (N, L_out, L_in), NaN (None) equals nothing
+            is_input = (out[:, :, None] == values[:, None, :]).any(axis=-1)
+            averaged = ~np.isnan(out) & ~is_input & mask
+            invalid |= averaged.any(axis=-1)
+        else:
+            binary = (values == 0) | (values == 1)
+            invalid |= (~binary & mask).any(axis=-1)
+    return invalid
 
 
 def tracr_dynamic_validate(program, inputs: list[list]):
-    for x in inputs:
-        if len(validating.validate(program, x)) > 0:
-            raise SamplingError(f"Program failed dynamic validation.")
+    """Raise a SamplingError if program fails dynamic validation on
+    any of the inputs (see dynamic_validate)."""
+    evaluator = BatchedEvaluator.from_inputs(inputs)
+    evaluator.evaluate(program)
+    if dynamic_validate(program, evaluator).any():
+        raise SamplingError("Program failed dynamic validation.",
+                            reason="dynamic validation")
 
 
-def is_constant(values: list[list[int | float]]) -> bool:
+def is_constant(values: np.ndarray, lengths: np.ndarray) -> bool:
     """Return True if the values are constant or almost constant.
+    values is a NaN-padded (N, max_len) array as returned by a
+    BatchedEvaluator, and lengths holds the N sequence lengths.
     If values have inhomogeneus lengths, they are treated as
     incomparable and only the subset of elements that are
     of the most frequent length are compared.
@@ -110,12 +158,10 @@ def is_constant(values: list[list[int | float]]) -> bool:
         )
         return False
 
-    lens = [len(x) for x in values]
-    if not all(l == lens[0] for l in lens):
-        most_common_len = Counter(lens).most_common(1)[0][0]
-        values = [x for x in values if len(x) == most_common_len]
-        return is_constant(values)
+    if not all(lengths == lengths[0]):
+        most_common_len = Counter(lengths.tolist()).most_common(1)[0][0]
+        keep = lengths == most_common_len
+        return is_constant(values[keep, :most_common_len], lengths[keep])
     else:
-        values = [[0 if x is None else x for x in v] for v in values]
-        values = np.array(values)
-        return values.std(axis=0).sum() < 0.5
\ No newline at end of file
+        values = np.nan_to_num(values[:, :lengths[0]], nan=0)
+        return values.std(axis=0).sum() < 0.5
@@ -0,0 +1,140 @@
+# Value sets of SOps, inferred the same way as in tracr's basis inference
+# (tracr.compiler.basis_inference), but without building the compiler graph.
+
+
+from typing import Iterable
+import itertools
+from tracr.rasp import rasp
+
+from rasp_gen.sample import rasp_utils
+
+
+# settings used by dataset/compile.py
+COMPILER_VOCAB = frozenset(range(5))
+COMPILER_MAX_SEQ_LEN = 5
+
+
+def _ignoring_arithmetic_errors(f: callable, *args):
+    try:
+        return f(*args)
+    except ArithmeticError:
+        return None
+
+
+def _means(
+    values: set,
+    max_seq_len: int,
+    default,
+    max_size: int = None,
+) -> set | None:
+    """All means of 1 to max_seq_len values (with repetition), plus the
+    default (the output where nothing is selected)."""
+    out = set() if default is None else {default}
+    sums = {0}
+    for n in range(1, max_seq_len + 1):
+        sums = {s + x for s in sums for x in values}
+        if max_size is not None and len(sums) * max_seq_len > max_size:
+            return None
+        out |= {s / n for s in sums}
+    return out
+
+
+def value_set(
+    sop: rasp.SOp,
+    children: Iterable[set],
+    vocab: set = COMPILER_VOCAB,
+    max_seq_len: int = COMPILER_MAX_SEQ_LEN,
+    max_size: int = None,
+    exact_means: bool = False,
+) -> set | None:
+    """Compute the value set of a SOp from the value sets of the
+    SOps it takes as input (in the order of rasp_utils.sop_args).
+    If max_size is given, give up (return None) instead of evaluating a 
+    SequenceMap on more than max_size pairs of values or computing a 
+    larger numerical Aggregate value set, and whenever a child's value
+    set is None.
+
+    Like tracr, the value set of a numerical Aggregate only holds x / n
+    for x in the input's value set, which misses e.g. 2/3, the mean of 
+    [1, 0, 1]. If exact_means, it holds every mean the Aggregate can
+    output instead, so that value sets contain all values a SOp takes."""
+    children = list(children)
+    if max_size is not None and any(c is None for c in children):
+        return None
+    if isinstance(sop, rasp.TokensType):
+        return set(vocab)
+    elif isinstance(sop, rasp.IndicesType):
+        return set(range(max_seq_len))
+    elif isinstance(sop, rasp.SelectorWidth):
+        return set(range(0, max_seq_len + 1))
+    elif isinstance(sop, rasp.Full):
+        return {sop.fill}
+    elif isinstance(sop, rasp.Map):
+        out = {_ignoring_arithmetic_errors(sop.f, x) for x in children[0]}
+        return out - {None}
+    elif isinstance(sop, rasp.SequenceMap):
+        if max_size is not None and len(children[0]) * len(children[1]) > max_size:
+            return None
+        out = {_ignoring_arithmetic_errors(sop.f, x, y)
+               for x, y in itertools.product(*children)}
+        return out - {None}
+    elif isinstance(sop, rasp.Aggregate):
+        sop_values = children[-1]
+        if rasp.is_categorical(sop):
+            return set(sop_values)
+        if exact_means:
+            return _means(sop_values, max_seq_len, sop.default, max_size)
+        if max_size is not None and len(sop_values) * max_seq_len > max_size:
+            return None
+        return {x / n for x in sop_values for n in range(1, max_seq_len + 1)}
+    raise ValueError(f"Unsupported SOp: {sop}")
+
+
+def infer_value_sets(
+    program: rasp.SOp,
+    vocab: set = COMPILER_VOCAB,
+    max_seq_len: int = COMPILER_MAX_SEQ_LEN,
+    exact_means: bool = False,
+) -> dict[str, set]:
+    """Return a dict mapping the label of every SOp in the program
+    to its value set (see value_set for exact_means)."""
+    value_sets = {}
+    for sop in rasp_utils.topological_order(program):
+        children = [value_sets[x.label] for x in rasp_utils.sop_args(sop)]
+        value_sets[sop.label] = value_set(
+            sop, children, vocab=vocab, max_seq_len=max_seq_len,
+            exact_means=exact_means)
+    return value_sets
+
+
+def predicate_values(
+    comparison: rasp.Comparison,
+    keys: set,
+    queries: set,
+) -> set[bool]:
+    """Return the set of values that comparison(key, query) takes over all
+    pairs of (numeric) keys and queries, without iterating over the pairs.
+    E.g. {False} means the Select never selects anything."""
+    if not keys or not queries:
+        return set()
+    k_min, k_max, q_min, q_max = min(keys), max(keys), min(queries), max(queries)
+    both_constant = k_min == k_max == q_min == q_max
+    if comparison == rasp.Comparison.TRUE:
+        some, every = True, True
+    elif comparison == rasp.Comparison.FALSE:
+        some, every = False, False
+    elif comparison == rasp.Comparison.EQ:
+        some, every = not keys.isdisjoint(queries), both_constant
+    elif comparison == rasp.Comparison.NEQ:
+        some, every = not both_constant, keys.isdisjoint(queries)
+    elif comparison == rasp.Comparison.LT:
+        some, every = k_min < q_max, k_max < q_min
+    elif comparison == rasp.Comparison.LEQ:
+        some, every = k_min <= q_max, k_max <= q_min
+    elif comparison == rasp.Comparison.GT:
+        some, every = k_max > q_min, k_min > q_max
+    elif comparison == rasp.Comparison.GEQ:
+        some, every = k_max >= q_min, k_min >= q_max
+    else:
+        raise ValueError(f"Unsupported comparison: {comparison}")
+    return ({True} if some else set()) | (set() if every else {False})
@@ -0,0 +1,171 @@
+# Fixed-seed benchmark of sampling throughput.
+# Times sample.sample for a range of program lengths (with and without
+# only_categorical) and generate.generate_batch (sampling, filtering and
+# tokenizing, saved to a temporary directory), and writes the results to
+# a json file. Pass the json of an earlier run to --compare to see how
+# throughput changed between commits.
+#
+# Usage:
+#   python scripts/benchmark_sampling.py --out before.json
+#   python scripts/benchmark_sampling.py --out after.json --compare before.json
+
+import argparse
+import json
+import logging
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+
+from rasp_gen.sample import sample
+from rasp_gen.sample.telemetry import SamplingTelemetry
+from rasp_gen.dataset import generate
+from rasp_gen.dataset.config import DatasetConfig
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far (not per benchmark)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, check=True, cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(
+    name: str,
+    length: int,
+    only_categorical: bool | None,
+    latencies: list[float],
+    n_programs: int,
+    telemetry: SamplingTelemetry,
+) -> dict:
+    latencies_ms = 1000 * np.array(latencies)
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    stats = telemetry.to_dict()
+    return {
+        "benchmark": name,
+        "length": length,
+        "only_categorical": only_categorical,
+        "n_programs": n_programs,
+        "programs_per_sec": n_programs / sum(latencies),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "attempts": {k: v["attempts"] for k, v in stats.items()},
+        "rejections": {k: v["rejections"] for k, v in stats.items()
+                       if v["rejections"]},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_sample(length: int, only_categorical: bool, n: int, seed: int) -> dict:
+    """Time n calls to sample.sample (latency per program)."""
+    rng = np.random.default_rng([seed, length, int(only_categorical)])
+    telemetry = SamplingTelemetry()
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        sample.sample(rng, length, telemetry=telemetry,
+                      only_categorical=only_categorical)
+        latencies.append(time.perf_counter() - start)
+    return summarize("sample", length, only_categorical, latencies, n, telemetry)
+
+
+def bench_generate_batch(
+    length: int,
+    n_batches: int,
+    batch_size: int,
+    seed: int,
+) -> dict:
+    """Time generate_batch (latency per batch, divided by batch size)."""
+    rng = np.random.default_rng([seed, length, 2])
+    telemetry = SamplingTelemetry()
+    latencies = []
+    n_programs = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = DatasetConfig(base_data_dir=Path(tmpdir), program_length=length,
+                               name="benchmark")
+        for _ in range(n_batches):
+            start = time.perf_counter()
+            data = generate.generate_batch(rng, batch_size, config,
+                                           disable_tqdm=True, telemetry=telemetry)
+            elapsed = time.perf_counter() - start
+            latencies.extend([elapsed / batch_size] * batch_size)
+            n_programs += len(data)
+    return summarize("generate_batch", length, None, latencies, n_programs,
+                     telemetry)
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float):
+    """Print throughput relative to a baseline run."""
+    key = lambda r: (r["benchmark"], r["length"], r["only_categorical"])
+    baseline = {key(r): r for r in baseline}
+    print(f"{'benchmark':<16}{'length':>7}{'only_cat':>10}"
+          f"{'prog/s':>10}{'before':>10}{'ratio':>8}{'p95 ms':>10}")
+    for r in results:
+        old = baseline.get(key(r))
+        if old is None:
+            continue
+        ratio = r["programs_per_sec"] / old["programs_per_sec"]
+        flag = "  <-- slower" if ratio < 1 - tolerance else ""
+        print(f"{r['benchmark']:<16}{r['length']:>7}"
+              f"{str(r['only_categorical']):>10}{r['programs_per_sec']:>10.1f}"
+              f"{old['programs_per_sec']:>10.1f}{ratio:>8.2f}"
+              f"{r['p95_ms']:>10.1f}{flag}")
+
+
+parser = argparse.ArgumentParser(description='Benchmark program sampling.')
+parser.add_argument('--lengths', type=int, nargs='+', default=list(range(4, 11)))
+parser.add_argument('--n', type=int, default=50,
+                    help="Number of programs per length for sample.sample.")
+parser.add_argument('--n_batches', type=int, default=3,
+                    help="Number of generate_batch calls per length.")
+parser.add_argument('--batch_size', type=int, default=10)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--skip_generate', action='store_true')
+parser.add_argument('--out', type=str, default="sampling_benchmark.json")
+parser.add_argument('--compare', type=str, default=None,
+                    help="Results of an earlier run to compare to.")
+parser.add_argument('--tolerance', type=float, default=0.1,
+                    help="Flag settings that got slower by more than this.")
+args = parser.parse_args()
+logging.disable(logging.INFO)  # the sampler logs every failed check
+
+results = []
+for length in args.lengths:
+    for only_categorical in (False, True):
+        results.append(bench_sample(length, only_categorical, args.n, args.seed))
+        print(f"sample          length {length:>2}  only_categorical="
+              f"{only_categorical!s:<5}  "
+              f"{results[-1]['programs_per_sec']:.1f} programs/sec")
+    if not args.skip_generate:
+        results.append(bench_generate_batch(
+            length, args.n_batches, args.batch_size, args.seed))
+        print(f"generate_batch  length {length:>2}  "
+              f"{results[-1]['programs_per_sec']:.1f} programs/sec")
+
+meta = {
+    "commit": git_commit(),
+    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    "python": platform.python_version(),
+    "args": vars(args),
+}
+with open(args.out, "w") as f:
+    json.dump({"meta": meta, "results": results}, f, indent=2)
+print(f"Saved results to {args.out}.")
+
+if args.compare is not None:
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    print(f"Compared to {args.compare} (commit {baseline['meta']['commit']}):")
+    compare(results, baseline["results"], args.tolerance)
@@ -0,0 +1,91 @@
+# Choose the test inputs that sample.sample passes to perform_checks.
+# Samples a corpus of programs (before the checks, so including ones
+# that get rejected), runs the checks on every input up to max_seq_len,
+# and greedily chooses inputs until the checks make the same decisions
+# as with all inputs (see rasp_gen/sample/input_cover.py). The chosen
+# inputs are then compared to all inputs and to the random inputs
+# (sample.EXTRA_TEST_INPUTS) on a held-out corpus. They are only saved
+# if they accept no held-out program that all inputs reject.
+#
+# Rerun this whenever perform_checks changes, and delete the saved file
+# if it can't be regenerated.
+#
+# Usage:
+#   python scripts/select_check_inputs.py --n_programs 200 --n_holdout 50
+# writes rasp_gen/sample/check_inputs.json, which sample.py loads instead
+# of sample.EXTRA_TEST_INPUTS.
+
+import argparse
+import json
+import logging
+import time
+import numpy as np
+from tqdm import tqdm
+
+from rasp_gen.sample import sample
+from rasp_gen.sample import input_cover
+from rasp_gen.sample.input_cover import InputCover
+
+
+def corpus(rng, lengths: list[int], n: int, inputs: list) -> list:
+    """Witnesses of n programs of each length."""
+    witnesses = []
+    for _ in tqdm(range(n), desc="Sampling corpus"):
+        for length in lengths:
+            program = input_cover.sample_candidates(rng, length)
+            witnesses.append(input_cover.check_witnesses(program, inputs))
+    return witnesses
+
+
+def report(name: str, cover: InputCover, chosen: list[int]) -> dict:
+    decisions = cover.decisions(chosen)
+    false_accepts = int((cover.target & ~decisions).sum())
+    false_rejects = int((~cover.target & decisions).sum())
+    print(f"{name:<8}{len(chosen):>8} inputs{false_accepts:>8} false accepts"
+          f"{false_rejects:>8} false rejects (of {len(decisions)} programs,"
+          f" {cover.target.sum()} rejected)")
+    return {"n_inputs": len(chosen), "false_accepts": false_accepts,
+            "false_rejects": false_rejects}
+
+
+parser = argparse.ArgumentParser(description='Choose inputs for perform_checks.')
+parser.add_argument('--lengths', type=int, nargs='+', default=list(range(4, 11)))
+parser.add_argument('--n_programs', type=int, default=200,
+                    help="Number of programs per length to choose inputs on.")
+parser.add_argument('--n_holdout', type=int, default=50,
+                    help="Number of held-out programs per length.")
+parser.add_argument('--max_inputs', type=int, default=150)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--out', type=str, default=str(sample.CHECK_INPUTS_PATH))
+args = parser.parse_args()
+logging.disable(logging.INFO)  # the sampler logs every failed check
+
+rng = np.random.default_rng(args.seed)
+inputs = input_cover.all_inputs()
+index = {x: i for i, x in enumerate(inputs)}
+random_inputs = sorted(index[x] for x in sample.EXTRA_TEST_INPUTS)
+cover = InputCover(inputs, corpus(rng, args.lengths, args.n_programs, inputs))
+cover.cover()
+cover.fix_constant(max_inputs=args.max_inputs)
+cover.fix_false_accepts(max_inputs=args.max_inputs)
+print(f"{cover.mismatches()} mismatches with all inputs on the corpus.")
+
+holdout = InputCover(inputs, corpus(rng, args.lengths, args.n_holdout, inputs))
+print("Decisions on held-out programs, compared to all inputs:")
+results = {
+    "cover": report("cover", holdout, cover.chosen),
+    "random": report("random", holdout, random_inputs),
+}
+if results["cover"]["false_accepts"] > 0:
+    raise SystemExit("The chosen inputs accept held-out programs that all "
+                     "inputs reject; not saving them.")
+
+meta = {
+    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    "args": vars(args),
+    "corpus_mismatches": cover.mismatches(),
+    "holdout": results,
+}
+with open(args.out, "w") as f:
+    json.dump({"meta": meta, "inputs": cover.chosen_inputs()}, f, indent=2)
+print(f"Saved {len(cover.chosen)} inputs to {args.out}.")
@@ -0,0 +1,16 @@
+import numpy as np
+
+from rasp_gen.sample import sample
+
+
+def grow_sampler(
+    rng: np.random.Generator,
+    n_steps: int = 30,
+    **sampler_kwargs,
+) -> sample.Sampler:
+    """Return a Sampler after n_steps calls to try_to_add_sop, for tests
+    that inspect its per-SOp state."""
+    sampler = sample.Sampler(rng, **sampler_kwargs)
+    for _ in range(n_steps):
+        sampler.try_to_add_sop(set())
+    return sampler
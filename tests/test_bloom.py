@@ -0,0 +1,47 @@
+import numpy as np
+
+from rasp_gen.dataset.bloom import BloomFilter, optimal_size
+from rasp_gen.dataset.config import DatasetConfig
+
+
+rng = np.random.default_rng(None)
+
+
+def test_no_false_negatives(tmp_path):
+    n_bits, n_hashes = optimal_size(1000, false_positive_rate=0.01)
+    bloom = BloomFilter(tmp_path / "bloom.bin", n_bits, n_hashes)
+    programs = {tuple(rng.integers(0, 100, size=20)) for _ in range(1000)}
+    assert np.mean([bloom.add(p) for p in programs]) < 0.05
+    assert all(p in bloom for p in programs)
+
+    unseen = [tuple(rng.integers(100, 200, size=20)) for _ in range(1000)]
+    false_positives = np.mean([p in bloom for p in unseen])
+    assert false_positives < 0.05
+
+
+def test_shared_and_snapshot(tmp_path):
+    path, snapshot = tmp_path / "bloom.bin", tmp_path / "snapshot.bin"
+    bloom = BloomFilter(path, 10_000)
+    bloom.add([1, 2, 3])
+    assert [1, 2, 3] in BloomFilter(path, 10_000)  # same file
+
+    bloom.snapshot(snapshot)
+    restored = BloomFilter(tmp_path / "new.bin", 10_000, snapshot=snapshot)
+    assert [1, 2, 3] in restored
+    assert [3, 2, 1] not in restored
+
+
+def test_from_config_keyed_by_data_dir(tmp_path):
+    config = DatasetConfig(base_data_dir=tmp_path / "a", bloom_filter_bits=10_000)
+    other = DatasetConfig(base_data_dir=tmp_path / "b", bloom_filter_bits=10_000)
+    bloom = BloomFilter.from_config(config, reset=True)
+    bloom.add([1, 2, 3])
+    assert [1, 2, 3] in BloomFilter.from_config(config)
+    assert [1, 2, 3] not in BloomFilter.from_config(other, reset=True)
+
+    bloom.snapshot(config.paths.bloom_filter)
+    bloom.add([4, 5, 6])
+    reset = BloomFilter.from_config(config, reset=True)  # back to snapshot
+    assert [1, 2, 3] in reset and [4, 5, 6] not in reset
+    for c in (config, other):
+        BloomFilter.from_config(c).path.unlink()
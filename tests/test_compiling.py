@@ -16,6 +16,7 @@ from tracr.compiler.craft_model_to_transformer import NoTokensError
 from rasp_gen.sample import rasp_utils
 from rasp_gen.sample import sample
 from rasp_gen.tokenize import tokenizer
+from rasp_gen.dataset import estimate
 
 rng = np.random.default_rng(None)
 
@@ -119,6 +120,37 @@ def test_retokenize_and_recompile(data):
     )
 
 
+def test_size_estimate(data):
+    """The size estimate should match the compiled model. The nr of params
+    is only a lower bound."""
+    for program, model in zip(data['programs'], data['compiled']):
+        est = estimate.estimate(program)
+        config = model.model_config
+        assert est.n_layers == config.num_layers
+        assert est.num_heads == config.num_heads
+        assert est.mlp_hidden_size == config.mlp_hidden_size
+        assert est.d_model == len(model.residual_labels)
+        assert est.n_tokens == len(tokenizer.tokenize(program))
+        assert est.n_params <= estimate.count_params(model.params)
+
+
+def test_params_lower_bound():
+    """estimate.too_large relies on n_params never exceeding the real
+    nr of params."""
+    seeded_rng = np.random.default_rng(0)
+    n_compiled = 0
+    for length in (4, 6, 8):
+        for _ in range(10):
+            program = _retokenize(sample.sample(seeded_rng, program_length=length))
+            model = _compile(program)
+            if model is None:
+                continue
+            n_compiled += 1
+            est = estimate.estimate(program)
+            assert est.n_params <= estimate.count_params(model.params)
+    assert n_compiled > 0
+
+
 def _retokenize_and_compile(program: rasp.SOp):
     program = tokenizer.detokenize(tokenizer.tokenize(program))
     return _compile(program)
@@ -0,0 +1,125 @@
+import pytest
+import numpy as np
+
+from tracr.rasp import rasp
+from tracr.compiler import validating
+
+from rasp_gen.sample import rasp_utils
+from rasp_gen.sample import sample
+from rasp_gen.sample import map_primitives
+from rasp_gen.sample.evaluate import BatchedEvaluator
+from rasp_gen.sample.validate import dynamic_validate
+from rasp_gen.dataset import lib
+from helpers import grow_sampler
+
+
+rng = np.random.default_rng(0)  # seeded, so that divergences reproduce
+
+INPUTS = [rasp_utils.sample_test_input(rng) for _ in range(200)]
+PROGRAMS = lib.examples + [
+    sample.sample(rng, program_length=length)
+    for length in (3, 5, 8) for _ in range(10)
+]
+# Intermediate SOps of a sampler run may contain Nones and fail to evaluate
+SAMPLER = grow_sampler(rng)
+
+
+def _programs_with_nones():
+    """Programs that contain None, so that tracr raises on some inputs."""
+    smaller = rasp.Select(rasp.tokens, rasp.tokens, rasp.Comparison.LT)
+    with_nones = rasp.Aggregate(smaller, rasp.tokens)  # None at the minimum
+    none_in_select = rasp.SelectorWidth(
+        rasp.Select(with_nones, rasp.indices, rasp.Comparison.EQ))
+    select_all = rasp.Select(rasp.indices, rasp.indices, rasp.Comparison.TRUE)
+    none_in_aggregate = rasp.Aggregate(select_all, with_nones)
+    same_index = rasp.Select(rasp.indices, rasp.indices, rasp.Comparison.EQ)
+    width_one_none = rasp.Aggregate(same_index, with_nones)  # doesn't raise
+    return [with_nones, none_in_select, none_in_aggregate, width_one_none]
+
+
+def _programs_failing_dynamic_validation():
+    select_all = rasp.Select(rasp.indices, rasp.indices, rasp.Comparison.TRUE)
+    prevs = rasp.Select(rasp.indices, rasp.indices, rasp.Comparison.LEQ)
+    categorical_mean = rasp.categorical(rasp.Aggregate(select_all, rasp.tokens))
+    numerical_tokens = rasp.numerical(rasp.Map(lambda x: x, rasp.tokens))
+    non_binary_mean = rasp.numerical(
+        rasp.Aggregate(prevs, numerical_tokens, default=0))
+    return [categorical_mean, non_binary_mean]
+
+
+PROGRAMS += _programs_with_nones() + _programs_failing_dynamic_validation()
+
+
+def _tracr_outputs(program: rasp.SOp, inputs: list[list]):
+    """Evaluate with tracr. Inputs that raise a ValueError are None."""
+    outputs = []
+    for x in inputs:
+        try:
+            outputs.append(program(x))
+        except ValueError:
+            outputs.append(None)
+    return outputs
+
+
+@pytest.mark.parametrize("program", PROGRAMS + SAMPLER.scope)
+def test_batched_evaluator_matches_tracr(program: rasp.SOp):
+    evaluator = BatchedEvaluator.from_inputs(INPUTS)
+    batched = evaluator.evaluate(program)
+    expected = _tracr_outputs(program, INPUTS)
+
+    for i, (x, out) in enumerate(zip(INPUTS, expected)):
+        if out is None:
+            assert evaluator.errors[i], (
+                f"tracr raised on input {x}, but batched evaluator did not.")
+            continue
+
+        assert not evaluator.errors[i], (
+            f"Batched evaluator flagged input {x} that tracr evaluates.")
+        out = np.array(out, dtype=float)
+        np.testing.assert_allclose(batched[i, :len(x)], out, rtol=1e-6,
+            err_msg=f"Outputs differ on input {x}.")
+        assert np.isnan(batched[i, len(x):]).all()
+
+
+def test_width_one_none_aggregate():
+    with_nones, _, none_in_aggregate, width_one_none = _programs_with_nones()
+    x = [0, 1, 2]
+    assert width_one_none(x) == with_nones(x) == [None, 0, 0.5]
+    with pytest.raises(ValueError):
+        none_in_aggregate(x)
+    evaluator = BatchedEvaluator.from_inputs([x])
+    assert np.isnan(evaluator.evaluate(width_one_none)[0, 0])
+    assert not evaluator.errors.any()
+    evaluator.evaluate(none_in_aggregate)
+    assert evaluator.none_in_aggregate.all()
+
+
+@pytest.mark.parametrize("program", PROGRAMS + SAMPLER.scope)
+def test_dynamic_validate_matches_tracr(program: rasp.SOp):
+    evaluator = BatchedEvaluator.from_inputs(INPUTS)
+    evaluator.evaluate(program)
+    invalid = dynamic_validate(program, evaluator)
+    for i, x in enumerate(INPUTS):
+        if evaluator.errors[i]:
+            continue  # tracr raises
+        tracr_evaluator = validating.DynamicValidationEvaluator()
+        tracr_evaluator.evaluate(program, x)
+        expected = len(tracr_evaluator.unsupported_exprs) > 0
+        assert invalid[i] == expected, (
+            f"Dynamic validation differs from tracr on input {x}.")
+
+
+@pytest.mark.parametrize("fn", map_primitives.ALL_FNS, ids=repr)
+def test_lookup_tables_match_functions(fn: map_primitives.FunctionWithRepr):
+    domain = np.array([0., 0.5, 1., 2., 3.5, 4.])
+    n_args = fn.fn.__code__.co_argcount
+    table = fn.table(*[domain] * n_args)
+    assert table.shape == (len(domain),) * n_args
+    for idx in np.ndindex(table.shape):
+        args = [map_primitives.to_python(domain[i]) for i in idx]
+        assert table[idx] == float(fn(*args))
+        assert fn.lookup(*args) == fn(*args)
+
+    if n_args == 1:  # memoized values are keyed by type
+        assert type(fn.lookup(True)) is type(fn(True))
+        assert type(fn.lookup(1)) is type(fn(1))
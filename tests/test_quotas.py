@@ -0,0 +1,51 @@
+import numpy as np
+
+from rasp_gen.dataset.config import DatasetConfig
+from rasp_gen.dataset.quotas import StratifiedQuotas
+
+
+rng = np.random.default_rng(None)
+
+
+def datapoint(n_sops, n_layers):
+    return {"n_sops": n_sops, "n_layers": n_layers}
+
+
+def test_strata():
+    quotas = StratifiedQuotas([4, 5], layer_bins=(5, 10), quota=1)
+    assert quotas.n_buckets == 3
+    assert quotas.stratum(datapoint(4, 5)) == (4, 0)
+    assert quotas.stratum(datapoint(4, 6)) == (4, 1)
+    assert quotas.stratum(datapoint(5, 11)) == (5, 2)
+
+
+def test_add_until_full():
+    quotas = StratifiedQuotas([4], layer_bins=(5,), quota=2,
+                              quotas={(4, 1): 1})
+    assert quotas.add(datapoint(4, 2))
+    assert quotas.add(datapoint(4, 3))
+    assert not quotas.add(datapoint(4, 4))
+    assert not quotas.full
+    assert quotas.add(datapoint(4, 8))
+    assert not quotas.add(datapoint(4, 9))
+    assert quotas.full
+    assert quotas.seen[(4, 0)] == 3
+
+
+def test_steer_away_from_full_lengths():
+    quotas = StratifiedQuotas([4, 5], layer_bins=(5,),
+                              quotas={(4, 0): 1, (4, 1): 1})
+    assert quotas.add(datapoint(4, 2))
+    assert quotas.add(datapoint(4, 8))
+    weights = quotas.length_weights()
+    assert weights[0] == 0 and weights[1] > 0
+    assert all(quotas.sample_length(rng) == 5 for _ in range(20))
+    assert not quotas.full  # length 5 has no quota
+
+
+def test_from_config():
+    assert StratifiedQuotas.from_config(DatasetConfig()) is None
+    quotas = StratifiedQuotas.from_config(
+        DatasetConfig(program_length=[4, 5], stratum_quota=10))
+    assert quotas.lengths == [4, 5]
+    assert quotas.remaining((4, 0)) == 10
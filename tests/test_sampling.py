@@ -13,10 +13,20 @@ from tracr.compiler import validating
 from rasp_gen.sample import rasp_utils
 from rasp_gen.sample.rasp_utils import SamplingError
 from rasp_gen.sample import sample
+from rasp_gen.sample.telemetry import SamplingTelemetry
+from rasp_gen.sample.op_weights import AdaptiveOpWeights
+from rasp_gen.sample.input_cover import InputCover
+from rasp_gen.sample import input_cover
+from rasp_gen.sample import program_primitives
+from rasp_gen.sample import map_primitives
+from rasp_gen.sample import mutate
+from rasp_gen.sample import enumeration
+from rasp_gen.sample.value_sets import infer_value_sets
 from rasp_gen.sample.validate import perform_checks
 from rasp_gen.tokenize import tokenizer
 from rasp_gen.tokenize import vocab
 from rasp_gen.dataset import lib
+from helpers import grow_sampler
 
 rng = np.random.default_rng(None)
 
@@ -99,6 +109,292 @@ def test_no_nones():
     )
 
 
+def test_backtrack():
+    """Test that backtracking pops SOps and leaves a consistent scope."""
+    sampler = grow_sampler(rng)
+    retries = Counter()
+    while len(sampler.scope) > 2:
+        n = len(sampler.scope)
+        sample.backtrack(sampler, retries, max_retries=1, program_length=LENGTH)
+        assert len(sampler.scope) < n
+        assert len(sampler.scope) == 2 or sampler.current_length() < LENGTH
+        for sop, past in zip(sampler.scope, sampler.past):
+            assert len(past) == rasp_utils.count_sops(sop)
+
+    assert not sample.backtrack(sampler, retries, max_retries=1,
+                                program_length=LENGTH)
+    assert len(sampler.scope) == 2
+
+
+def test_telemetry():
+    telemetry = SamplingTelemetry()
+    for _ in range(5):
+        sample.sample(rng, program_length=5, telemetry=telemetry)
+    stats = telemetry.to_dict()
+    assert stats["program"]["accepted"] == 5
+    for op_class, s in stats.items():
+        assert s["accepted"] + sum(s["rejections"].values()) == s["attempts"]
+
+    merged = SamplingTelemetry().merge(telemetry).merge(telemetry)
+    assert merged.attempts["program"] == 2 * telemetry.attempts["program"]
+
+
+def test_adaptive_op_weights():
+    op_weights = AdaptiveOpWeights(warmup=20, update_every=10)
+    for _ in range(10):
+        program = sample.sample(rng, program_length=5, op_weights=op_weights)
+        assert program.annotations["length"] == 5
+    assert not op_weights.warming_up
+    marginals = op_weights.marginals()
+    assert np.isclose(sum(m["target"] for m in marginals.values()), 1)
+    for m in marginals.values():
+        assert 1 / op_weights.max_correction <= m["correction"]
+        assert m["correction"] <= op_weights.max_correction
+
+
+def test_goal_directed():
+    for length in (3, 6):
+        telemetry = SamplingTelemetry()
+        program = sample.sample(rng, program_length=length, 
+                                goal_directed=True, telemetry=telemetry)
+        assert program.annotations["length"] == length
+        assert rasp_utils.count_sops(program) == length
+
+    sampler = sample.Sampler(rng, target_length=4)
+    for _ in range(30):
+        sampler.try_to_add_sop(set())
+        assert sampler.current_length() <= 4
+        for idx, sop in enumerate(sampler.scope):
+            n_uses = sum(sop.label in {a.label for a in rasp_utils.sop_args(s)}
+                         for s in sampler.scope)
+            assert sampler.n_uses[idx] == n_uses
+
+
+def test_structural_hash():
+    sampler = grow_sampler(rng)
+    hashes = [rasp_utils.structural_hash(sop) for sop in sampler.scope]
+    assert len(set(hashes)) == len(hashes)
+    assert sampler.index_by_hash == {h: i for i, h in enumerate(hashes)}
+
+    x = sampler.scope[-1]
+    reconstructed = tokenizer.detokenize(tokenizer.tokenize(x))
+    assert rasp_utils.is_equal(x, reconstructed)
+    assert not rasp_utils.is_equal(x, rasp.Map(lambda v: v, x))
+
+    select = rasp.Select(rasp.tokens, rasp.indices, rasp.Comparison.EQ)
+    select_lt = rasp.Select(rasp.tokens, rasp.indices, rasp.Comparison.LT)
+    width = rasp.SelectorWidth(select)
+    assert rasp_utils.is_equal(width, rasp.SelectorWidth(select))
+    assert not rasp_utils.is_equal(width, rasp.SelectorWidth(select_lt))
+    assert not rasp_utils.is_equal(width, rasp.numerical(rasp.SelectorWidth(select)))
+
+    fn = map_primitives.NONLINEAR_SEQMAP_FNS[0]
+    assert (rasp_utils.sequence_map_hash(fn, rasp.tokens, rasp.indices) ==
+            rasp_utils.structural_hash(
+                rasp.SequenceMap(fn, rasp.tokens, rasp.indices)))
+
+
+def test_known_failures():
+    sampler = grow_sampler(rng)
+    assert len(sampler.failed) == len(sampler.scope)
+    for failed in sampler.failed:
+        assert not failed & sampler.index_by_hash.keys()
+
+    def build():
+        sop = rasp.Map(lambda x: x, sampler.scope[-1], simplify=False)
+        return rasp_utils.annotate_type(sop, "categorical")
+    sampler.record_failure(build())
+    assert sampler.is_known_failure(build())
+    with pytest.raises(SamplingError) as e:
+        sampler.add_to_scope(build())
+    assert e.value.reason == "known failure"
+
+    sampler.pop_from_scope()
+    assert len(sampler.failed) == len(sampler.scope)
+
+
+def test_selector_cache():
+    sampler = grow_sampler(rng)
+    assert len(sampler.selectors) == len(sampler.scope)
+    for selectors in sampler.selectors:
+        for info in selectors.values():
+            for x, widths in zip(sample.TEST_INPUTS, info.widths):
+                assert list(widths) == [sum(row) for row in info.select(list(x))]
+
+    tokens, indices = sampler.scope[:2]
+    same = sampler.cached_selector(indices, indices, rasp.Comparison.EQ)
+    assert same is sampler.cached_selector(indices, indices, rasp.Comparison.EQ)
+    assert sampler.is_width_one(same)
+    select_all = sampler.cached_selector(tokens, tokens, rasp.Comparison.TRUE)
+    assert not sampler.is_width_one(select_all)
+
+
+def test_macros():
+    for macro in program_primitives.MACROS:
+        program = macro.build(rasp.tokens, set(range(5)), rng)
+        assert program.annotations["type"] == macro.output_type
+        assert len(validating.validate(program)) == 0
+        for x in sample.TEST_INPUTS:
+            assert len(validating.validate(program, list(x))) == 0
+    reverse = program_primitives.reverse(rasp.tokens, None, rng)
+    assert reverse([1, 2, 3]) == [3, 2, 1]
+
+    for values in [{1.5, 2, 3, 4, -1}, {0, 3, 4}]:
+        program = program_primitives.pair_balance(rasp.tokens, values, rng)
+        tokenizer.tokenize(program)
+        assert len(validating.validate(program)) == 0
+    with pytest.raises(SamplingError):  # only 0 has an x == n primitive
+        program_primitives.pair_balance(rasp.tokens, {0, 4}, rng)
+
+    sampler = grow_sampler(rng, use_macros=True)
+    assert sampler.telemetry.attempts["macro"] > 0
+    for sop, past in zip(sampler.scope, sampler.past):
+        assert len(past) == rasp_utils.count_sops(sop)
+    for _ in range(10):
+        program = sample.sample(rng, program_length=LENGTH, use_macros=True)
+        assert program.annotations["length"] == LENGTH
+        tokenizer.tokenize(program)
+
+
+def test_harvest():
+    telemetry = SamplingTelemetry()
+    harvested = []
+    for _ in range(5):
+        sample.sample(rng, program_length=8, telemetry=telemetry,
+                      harvested=harvested, harvest_lengths=range(4, 8))
+    assert telemetry.attempts["harvest"] >= len(harvested)
+    for program in harvested:
+        assert program.annotations["length"] in range(4, 8)
+        assert rasp_utils.count_sops(program) == program.annotations["length"]
+        perform_checks(program, sample.CHECK_INPUTS)
+
+
+def test_mutate():
+    telemetry = SamplingTelemetry()
+    n_mutants = 0
+    for program in PROGRAMS[:20]:
+        program = tokenizer.detokenize(tokenizer.tokenize(program))
+        try:
+            mutant = mutate.mutate(rng, program, telemetry=telemetry)
+        except SamplingError:
+            continue
+        n_mutants += 1
+        assert not rasp_utils.is_equal(mutant, program)
+        assert mutant.annotations["length"] == rasp_utils.count_sops(mutant)
+        tokenizer.tokenize(mutant)
+    assert n_mutants > 0
+    accepted = sum(telemetry.attempts[f"mutate_{kind}"] - 
+                   sum(telemetry.rejections[f"mutate_{kind}"].values())
+                   for kind in mutate.MUTATIONS)
+    assert accepted == n_mutants
+
+
+def test_rewire():
+    for program in PROGRAMS[:20]:
+        program = tokenizer.detokenize(tokenizer.tokenize(program))
+        order = rasp_utils.topological_order(program)
+        types, values = mutate.infer_types(order)
+        rewired = mutate.rewire(rng, program, order, types, values)
+        if rewired is None:
+            continue
+        args = [x.label for x in rasp_utils.sop_args(program)]
+        new_args = [x.label for x in rasp_utils.sop_args(rewired)]
+        assert sum(a != b for a, b in zip(args, new_args)) == 1
+        assert set(new_args) <= {x.label for x in order[:-1]}
+        break
+    else:
+        assert False, "rewire never produced a mutant."
+
+
+def test_enumeration():
+    enumerator = enumeration.Enumerator(max_length=3)
+    hashes = [rasp_utils.structural_hash(sop) for sop in enumerator.sops]
+    assert len(set(hashes)) == len(hashes)
+    lengths = [p.annotations["length"] for p in enumerator.programs()]
+    assert lengths == sorted(lengths)
+    for program in enumerator.programs():
+        assert rasp_utils.count_sops(program) == program.annotations["length"]
+
+    # every map of tokens the sampler can build is enumerated
+    sampler = sample.Sampler(rng)
+    for _ in range(20):
+        try:
+            sampler.add_map()
+        except SamplingError:
+            continue
+        sop = sampler.scope[-1]
+        if sampler.current_length() == 2:
+            assert rasp_utils.structural_hash(sop) in enumerator.index_by_hash
+        sampler.pop_from_scope()
+
+    telemetry = SamplingTelemetry()
+    programs = list(enumeration.enumerate_programs(2, telemetry=telemetry))
+    split = [list(enumeration.enumerate_programs(2, worker=w, n_workers=2))
+             for w in range(2)]
+    assert len(programs) == len(split[0]) + len(split[1])
+    assert telemetry.attempts["enumerate"] == len(list(
+        enumeration.Enumerator(max_length=2).programs()))
+
+
+def test_value_sets():
+    sampler = grow_sampler(rng)
+    inferred = infer_value_sets(sampler.scope[-1], exact_means=True)
+    for sop, values in zip(sampler.scope, sampler.value_sets):
+        if values is not None and sop.label in inferred:
+            assert values == inferred[sop.label]
+        if values is not None:
+            for x in sample.TEST_INPUTS:
+                assert set(sampler.evaluate(sop, x)) - {None} <= values
+
+    prevs = rasp.Select(rasp.indices, rasp.indices, rasp.Comparison.LEQ)
+    frac = rasp.numerical(rasp.Aggregate(prevs, rasp.numerical(
+        rasp.Map(lambda x: x % 2, rasp.tokens)), default=0))
+    values = infer_value_sets(frac, exact_means=True)[frac.label]
+    assert 2/3 in values and 2/3 not in infer_value_sets(frac)[frac.label]
+
+
+def test_input_cover():
+    inputs = input_cover.all_inputs(max_seq_len=3)
+    assert len(inputs) == 5 + 5**2 + 5**3
+    programs = [input_cover.sample_candidates(rng, 5) for _ in range(20)]
+    cover = InputCover(
+        inputs, [input_cover.check_witnesses(p, inputs) for p in programs])
+    cover.cover()
+    decisions = cover.decisions()
+    assert decisions[cover.target & cover.rejects.any(axis=1)].all()
+    before = cover.mismatches()
+    cover.fix_constant()
+    assert cover.mismatches() <= before
+    lengths = Counter(len(x) for x in cover.chosen_inputs())
+    assert lengths.most_common(1)[0][0] == 3
+    assert lengths[3] >= input_cover.MIN_CONSTANT_INPUTS
+    cover.fix_false_accepts(max_inputs=len(inputs))
+    false_accepts = cover.target & ~cover.decisions()
+    assert not cover.rejects[false_accepts].any()
+
+    seeded = InputCover(
+        inputs, [input_cover.check_witnesses(p, inputs) for p in programs])
+    seeded.chosen = list(range(10))
+    seeded.cover()
+    assert seeded.chosen[:10] == list(range(10))
+    assert seeded.decisions()[seeded.target & seeded.rejects.any(axis=1)].all()
+
+
+@pytest.mark.skipif(not sample.CHECK_INPUTS_PATH.exists(),
+                    reason="scripts/select_check_inputs.py hasn't been run")
+def test_shipped_check_inputs():
+    """The shipped check inputs never accept a program that all inputs
+    reject."""
+    inputs = input_cover.all_inputs()
+    index = {x: i for i, x in enumerate(inputs)}
+    programs = [input_cover.sample_candidates(rng, length)
+                for length in range(4, 11) for _ in range(5)]
+    cover = InputCover(
+        inputs, [input_cover.check_witnesses(p, inputs) for p in programs])
+    cover.chosen = [index[x] for x in sample.CHECK_INPUTS]
+    assert not (cover.target & ~cover.decisions()).any()
+
+
 def _mostly_constant_wrt_input(outputs: ArrayLike) -> bool:
     """Check if program is constant wrt input. 
     Returns True if >80% of inputs produce exactly the same output.